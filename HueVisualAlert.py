@@ -12,41 +12,89 @@ An implementation of Philips Hue as a status indicator.
 Philips Electronics N.V. See www.meethue.com for more information.
 """
 
+import time
+# Start of the program, for time-to-first-light; includes the imports below
+START_TIME = time.monotonic()
+
 import huecontroller
+import metrics
+import phue
 from PhoneStatsAPI import PhoneStatsAPI
+from businesshours import OperatingHours
+from circuitbreaker import CircuitBreaker
+from configwatch import ConfigWatcher
+from rules import RuleEngine
 import logging
 import atexit
 import datetime
-import time
 import json
 import sys
 import re
 import os
 import calendar
-# These two needed for Negotiate auth to work after being build by pyinstaller
-from multiprocessing import Queue
-import win32timezone
-
-args = set(sys.argv)
-if '-d' in args or '--debug' in args:
-	logging.basicConfig(level=logging.DEBUG)
-elif '-i' in args or '--info' in args:
-	logging.basicConfig(level=logging.INFO)
-else:
-	logging.basicConfig(level=logging.INFO)
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
 logger = logging.getLogger('TSPhillyVisualAlert')
 
-if '--stop' in args:
-	STOP = True
-else:
-	STOP = False
+# Set from the command line by main()
+STOP = False
 
 default_config = {
 	'manualBridgeIP': None,
+	'bridgeCacheFile': 'bridge.json',
+	'floors': [],
+	'metricsPort': None,
+	'profileCycles': 50,
+	'configCheckInterval': 2,
 	'delayTime': 1,
-	'callQueueURL': 'http://tsdata/api/incontact/huedata/fl_english_ib',
-	'voicemailQueueURL': 'http://tsdata/api/incontact/huedata/VM_English',
+	'minDelayTime': 0.5,
+	'maxDelayTime': 5,
+	'queues': 
+		[
+		{'name': 'calls', 		'url': 'http://tsdata/api/incontact/huedata/fl_english_ib', 'weight': 1},
+		{'name': 'voicemail', 	'url': 'http://tsdata/api/incontact/huedata/VM_English', 'weight': 1}
+		],
+	'queueAggregation': {'ready': 'first', 'calls': 'sum', 'waitTime': 'max'},
+	'maxConcurrentPolls': 8,
 	'phoneQueueTimeout': 15,
+	'phoneQueueDeadline': 1,
+	'phoneQueueConnectTimeout': 2,
+	'phoneQueueReadTimeout': 5,
+	'phoneQueueHedgeQuantile': None,
+	'phoneQueueBreaker': {'failureThreshold': 3, 'resetTimeout': 5, 'maxResetTimeout': 120},
+	'bridgeConnectTimeout': 2,
+	'bridgeReadTimeout': 5,
+	'bridgeBreaker': {'failureThreshold': 3, 'resetTimeout': 2, 'maxResetTimeout': 60},
+	'asyncLightDispatch': True,
+	'bridgeScenes': True,
+	'bridgeSchedules': True,
+	'bridgeScheduleDays': 14,
+	'rules':
+		{
+		'scoring': {'calls': 1, 'waitMinutes': 1, 'ready': 0},
+		'bands':
+			[
+			{'min': 0, 		'state': 'green', 'readyState': 'blue'},
+			{'above': 0, 	'state': 'greenYellow'},
+			{'min': 4, 		'state': 'yellow'},
+			{'min': 7, 		'state': 'orange'},
+			{'min': 9, 		'state': 'red'}
+			],
+		'overrides': []
+		},
+	'operatingHours':
+		{
+		'monday':		[['07:00', '19:00']],
+		'tuesday':		[['07:00', '19:00']],
+		'wednesday':	[['07:00', '19:00']],
+		'thursday':		[['07:00', '19:00']],
+		'friday':		[['07:00', '19:00']],
+		'saturday':		[['11:00', '21:00']],
+		'sunday':		[['11:00', '21:00']],
+		'holidays':		[]
+		},
 	'lightStates': 
 		{
 		'red': 			{'on': True, 'bri': 200, 'sat': 255, 'transitiontime': 4, 'xy': [0.8, 0.3]},
@@ -61,17 +109,57 @@ default_config = {
 		}
 }
 
-if os.path.isfile('config.json'):
-	logger.debug('Found config.json, attempting to load configuration.')
-	with open('config.json') as f:
-		try:
-			config = json.loads(f.read())
-			logger.debug('Successfully loaded configuration file.')
-		except:
-			logger.warning('Failed to load from config.json, using default config.')
-			logger.warning('config.json may be corrupted. Delete config.json to create default config file.')
-			config = default_config
-			time.sleep(5)
+# Light states the monitor uses besides those chosen by the rules, which 
+# every config must define
+LIGHT_STATE_NAMES = ('allOn', 'noConnect', 'allOff')
+
+NUMBER = (int, float)
+
+# Types each config entry may have, checked by validate_config
+CONFIG_TYPES = {
+	'manualBridgeIP': (str, type(None)),
+	'bridgeCacheFile': (str,),
+	'floors': (list,),
+	'metricsPort': (int, type(None)),
+	'profileCycles': (int,),
+	'configCheckInterval': NUMBER,
+	'delayTime': NUMBER,
+	'minDelayTime': NUMBER,
+	'maxDelayTime': NUMBER,
+	'queues': (list,),
+	'queueAggregation': (dict,),
+	'maxConcurrentPolls': (int,),
+	'phoneQueueTimeout': NUMBER,
+	'phoneQueueDeadline': NUMBER,
+	'phoneQueueConnectTimeout': NUMBER,
+	'phoneQueueReadTimeout': NUMBER,
+	'phoneQueueHedgeQuantile': NUMBER + (type(None),),
+	'phoneQueueBreaker': (dict,),
+	'bridgeConnectTimeout': NUMBER,
+	'bridgeReadTimeout': NUMBER,
+	'bridgeBreaker': (dict,),
+	'asyncLightDispatch': (bool,),
+	'bridgeScenes': (bool,),
+	'bridgeSchedules': (bool,),
+	'bridgeScheduleDays': (int,),
+	'rules': (dict,),
+	'operatingHours': (dict,),
+	'lightStates': (dict,),
+}
+
+def read_config(path='config.json'):
+	"""Reads the configuration from path, filling in defaults for missing 
+	keys. Raises ValueError if the file is not valid JSON or the 
+	configuration could not be used, OSError if it cannot be read."""
+	with open(path) as f:
+		config = json.loads(f.read())
+	if not isinstance(config, dict):
+		raise ValueError('{} does not contain a JSON object'.format(path))
+	if 'queues' not in config and 'callQueueURL' in config:
+		logger.warning("Converting 'callQueueURL' and 'voicemailQueueURL' to 'queues'.")
+		config['queues'] = [{'name': 'calls', 'url': config['callQueueURL']}]
+		if 'voicemailQueueURL' in config:
+			config['queues'].append({'name': 'voicemail', 'url': config['voicemailQueueURL']})
 	config_valid = True
 	for k in default_config.keys():
 		if k not in config.keys():
@@ -81,155 +169,576 @@ if os.path.isfile('config.json'):
 	if not config_valid:
 		logger.warning('Config file does not contain all keys expected.')
 		logger.warning('Using default values for missing configuration options.')
+	validate_config(config)
+	return config
+
+def validate_config(config):
+	"""Raises ValueError if a floor of config lacks something the monitor 
+	needs at run time: entries of the right types, its light states, queue 
+	URLs, valid rules or hours."""
+	if not isinstance(config.get('floors'), list) or not all(isinstance(floor, dict) for floor in config['floors']):
+		raise ValueError('floors must be a list of objects')
+	names = [settings.get('name') for settings in floor_settings(config)]
+	if len(set(names)) != len(names):
+		raise ValueError('floors need different names: {}'.format(names))
+	for settings in floor_settings(config):
+		floor = settings.get('name', 'config')
+		for key, types in CONFIG_TYPES.items():
+			value = settings[key]
+			# bool is an int, but not a number of seconds
+			if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+				raise ValueError("{}: '{}' must be of type {}, not {}".format(
+					floor, key, ' or '.join(t.__name__ for t in types), type(value).__name__))
+		try:
+			rules = RuleEngine.from_config(settings['rules'])
+		except (KeyError, TypeError, ValueError, AttributeError) as e:
+			raise ValueError('{}: invalid rules: {}'.format(floor, e))
+		for name in sorted(rules.state_names()) + list(LIGHT_STATE_NAMES):
+			if not isinstance(settings['lightStates'].get(name), dict):
+				raise ValueError("{}: lightStates has no '{}' state".format(floor, name))
+		for name, state in settings['lightStates'].items():
+			perLight = state.get('lights', {}) if isinstance(state, dict) else {}
+			if not isinstance(perLight, dict) or not all(isinstance(value, dict) for value in perLight.values()):
+				raise ValueError("{}: 'lights' of light state '{}' must map light ids to attributes".format(floor, name))
+		if not settings['queues'] or not all(isinstance(queue, dict) and 'url' in queue for queue in settings['queues']):
+			raise ValueError('{}: every queue needs a url'.format(floor))
+		for name in ('phoneQueueBreaker', 'bridgeBreaker'):
+			if not all(isinstance(value, NUMBER) for value in settings[name].values()):
+				raise ValueError("{}: the settings of '{}' must be numbers".format(floor, name))
+		try:
+			OperatingHours.from_config(settings['operatingHours'])
+		except (KeyError, TypeError, ValueError, AttributeError) as e:
+			raise ValueError('{}: invalid operatingHours: {}'.format(floor, e))
+
+def load_config(path='config.json'):
+	"""Reads the configuration from path, see read_config. Falls back to the
+	default configuration if it cannot be used, and creates the file with 
+	the default configuration if it does not exist."""
+	if os.path.isfile(path):
+		logger.debug('Found {}, attempting to load configuration.'.format(path))
+		try:
+			config = read_config(path)
+			logger.debug('Successfully loaded configuration file.')
+		except (OSError, ValueError) as e:
+			logger.warning('Failed to load from {}, using default config: {}'.format(path, e))
+			logger.warning('{0} may be corrupted. Delete {0} to create default config file.'.format(path))
+			config = default_config
+			time.sleep(5)
+	else:
+		logger.warning('No {} file found. Creating one with default values.'.format(path))
+		config = default_config
+		with open(path, mode='w') as f:
+			f.write(json.dumps(default_config, indent=4))
+	return config
+
+# Loaded by main(), or on first use by PhoneStatusMonitor or floor_settings
+config = None
+
+def get_config():
+	global config
+	if config is None:
+		config = load_config()
+	return config
 		
-else:
-	logger.warning('No config.json file found. Creating one with default values.')
-	config = default_config
-	with open('config.json', mode='w') as f:
-		f.write(json.dumps(default_config, indent=4))
-		
 
+STATE_TRANSITIONS = metrics.registry.counter('light_state_transitions_total',
+	'Changes of the light state chosen by the monitor.', ('floor', 'state'))
+FAIL_COUNT = metrics.registry.gauge('phone_queue_fail_count',
+	'Consecutive cycles in which no queue could be read.', ('floor',))
+POINTS = metrics.registry.gauge('phone_queue_points',
+	'Priority points calculated in the last cycle.', ('floor',))
+FIRST_LIGHT_SECONDS = metrics.registry.gauge('time_to_first_light_seconds',
+	'Seconds from program start until the first light state was sent.', ('floor',))
+
+# Rules for combining one metric across queues in get_new_stats. Each takes
+# a list of (queue config, value) pairs from the queues that responded, in
+# the order the queues are configured. 'first' takes the first of them, so
+# agents ready come from the calls queue while it answers.
+aggregation_rules = {
+	'first':	lambda values: values[0][1],
+	'sum':		lambda values: sum(value for queue, value in values),
+	'max':		lambda values: max(value for queue, value in values),
+	'weighted':	lambda values: sum(queue.get('weight', 1) * value for queue, value in values)
+}
 			
 class PhoneStatusMonitor(huecontroller.BaseURLMonitor):
 	"""
-	Monitors the Tech Support phone queue and sends light state commands
+	Monitors the Tech Support phone queues and sends light state commands
 	to the HueController.
 	
 	"""
 	
-	def __init__(self, controller):
+	def __init__(self, controller, settings=None, watcher=None, floor=0):
+		"""settings : dict, optional
+		
+		Configuration for this monitor, defaults to the loaded config.
+		Floors pass the config merged with their own entries.
+		
+		watcher : configwatch.ConfigWatcher, optional
+		floor : int, optional
+		
+		If a watcher is given, the settings of the floor'th floor are 
+		applied again whenever it reloads the config. Bridge settings 
+		still need a restart."""
 		huecontroller.BaseURLMonitor.__init__(self, controller)
-		self.callQueueAPI = PhoneStatsAPI(config['callQueueURL'], timeout=config['phoneQueueTimeout'])
-		self.voicemailQueueAPI = PhoneStatsAPI(config['voicemailQueueURL'], timeout=config['phoneQueueTimeout'])
-		self.states = config['lightStates']
+		if settings is None:
+			settings = get_config()
+		self.watcher = watcher
+		self.floor = floor
+		self.configSource = watcher.config if watcher is not None else None
+		self.queues = None
+		self.queueKey = None
+		self.queueAPIs = []
+		self.pollExecutor = None
+		self.pendingPolls = {}
+		self.states = None
+		self.asyncDispatch = False
+		self.appliedState = None
+		self.configure(settings)
 		self.state = self.states['allOn']
 		self.status = ''
 		self.failCount = 0
-		self.checkInterval = config['delayTime']
+		self.failSince = None
+		# Longest sleep while closed, so wall clock changes are caught up with
+		self.maxStandbyInterval = 3600
+		self.interval = self.checkInterval
 		self.maxDisconnectTime = 15
+		self.points = None
+		self.lastPoints = None
 		self.tic = time.time()
+		self.firstLightSeconds = None
 		atexit.register(self.reset_lights)
 	
+	def configure(self, settings):
+		"""Applies settings, when created and when the config is reloaded.
+		Everything is built before anything is replaced, so settings that 
+		raise an exception leave the monitor as it was."""
+		# queue APIs keep connections and circuit breakers, so they are only
+		# replaced when their settings change
+		queueKey = json.dumps([settings['queues'], settings['maxConcurrentPolls']] + 
+			[settings[key] for key in sorted(settings) if key.startswith('phoneQueue')], sort_keys=True)
+		if queueKey != self.queueKey:
+			queueAPIs = [self.queue_api(queue, settings) for queue in settings['queues']]
+			pollExecutor = ThreadPoolExecutor(max_workers=max(1, min(settings['maxConcurrentPolls'], len(queueAPIs))))
+		else:
+			queueAPIs, pollExecutor = self.queueAPIs, self.pollExecutor
+		aggregation = dict(default_config['queueAggregation'])
+		for metric, rule in settings['queueAggregation'].items():
+			if rule in aggregation_rules:
+				aggregation[metric] = rule
+			else:
+				logger.warning("Unknown aggregation rule '{}' for {}, using '{}'.".format(
+					rule, metric, aggregation.get(metric)))
+		# encoded once here rather than by every set_state
+		states = dict((name, huecontroller.LightState(state)) for name, state in settings['lightStates'].items())
+		operatingHours = OperatingHours.from_config(settings['operatingHours'])
+		rules = RuleEngine.from_config(settings['rules'], states)
+		
+		self.name = settings.get('name', '')
+		if pollExecutor is not self.pollExecutor:
+			if self.pollExecutor is not None:
+				# polls still running finish on their own
+				self.pollExecutor.shutdown(wait=False)
+			self.queues, self.queueKey = settings['queues'], queueKey
+			self.queueAPIs, self.pollExecutor = queueAPIs, pollExecutor
+			self.pendingPolls = {}
+		self.aggregation = aggregation
+		self.pollDeadline = settings['phoneQueueDeadline']
+		self.checkInterval = settings['delayTime']
+		self.minInterval = settings['minDelayTime']
+		self.maxInterval = settings['maxDelayTime']
+		self.operatingHours = operatingHours
+		self.rules = rules
+		# queued before any state below, so that it can use the scenes
+		self.bridgeFeatures = (settings['bridgeScenes'], settings['bridgeSchedules'])
+		self.bridgeScheduleDays = settings['bridgeScheduleDays']
+		self.sync_bridge(states, operatingHours)
+		if self.states is not None:
+			# show the new colours of the current state right away
+			stateName = self.state_name(self.state)
+			self.states = states
+			if stateName in states and states[stateName] != self.state:
+				self.state = states[stateName]
+				self.apply_state(self.state)
+			else:
+				self.state = states.get(stateName, self.state)
+		self.states = states
+		# Send light states from the controller's dispatcher thread, so a
+		# slow Bridge does not hold up polling
+		self.asyncDispatch = settings['asyncLightDispatch']
+		if self.asyncDispatch:
+			self.controller.start_dispatcher(self.dispatched)
+	
+	def sync_bridge(self, states=None, operatingHours=None):
+		"""Programs the Bridge with states and operatingHours (default: the
+		current ones). With a scene per state, changing state is a single 
+		small request and states can give lights different colours. With 
+		schedules, the Bridge turns the lights on and off with the operating
+		hours by itself, also while this program is not running. The 
+		schedules cover bridgeScheduleDays days ahead, and are extended when
+		bridgeSyncDue comes.
+		
+		The requests are made on the controller's dispatcher thread, also
+		without asyncLightDispatch, and do not hold the controller's 
+		bridgeLock, so neither polling nor set_state waits for them. 
+		bridgePending is set if they failed and should be retried."""
+		states = states or self.states
+		operatingHours = operatingHours or self.operatingHours
+		scenes, schedules = self.bridgeFeatures
+		days = self.bridgeScheduleDays
+		self.bridgePending = False
+		self.bridgeSyncDue = time.time() + 86400
+		if not (scenes or schedules):
+			return
+		def sync():
+			done = True
+			if scenes:
+				done = self.controller.sync_scenes(states) and done
+			if schedules:
+				# after the scenes, so the schedules can recall them
+				done = self.controller.sync_schedules(operatingHours, states['allOn'], states['allOff'], days) and done
+			return done
+		def synced(done):
+			if not done:
+				self.bridgePending = True
+		self.controller.call_soon(sync, synced)
+	
+	def check_config(self):
+		"""Applies the config file's settings if the watcher reloaded it."""
+		if self.watcher is None:
+			return
+		config = self.watcher.check()
+		if config is self.configSource:
+			return
+		self.configSource = config
+		try:
+			self.configure(floor_settings(config)[self.floor])
+		except Exception as e:
+			# whatever is wrong with it, the monitor keeps running as it was
+			logger.warning('Could not apply the reloaded config, keeping the previous settings: {}'.format(e))
+			return
+		logger.info('Applied the reloaded config.')
+	
+	def queue_api(self, queue, settings):
+		"""Creates the PhoneStatsAPI for a queue. The queue's own entries
+		override the phoneQueue* settings."""
+		breakerSettings = dict(settings['phoneQueueBreaker'])
+		breakerSettings.update(queue.get('breaker', {}))
+		return PhoneStatsAPI(queue['url'],
+			timeout=queue.get('timeout', settings['phoneQueueTimeout']),
+			connectTimeout=queue.get('connectTimeout', settings['phoneQueueConnectTimeout']),
+			readTimeout=queue.get('readTimeout', settings['phoneQueueReadTimeout']),
+			hedgeQuantile=queue.get('hedgeQuantile', settings['phoneQueueHedgeQuantile']),
+			breaker=CircuitBreaker.from_config(queue['url'], breakerSettings))
+	
+	def poll_queues(self, apis):
+		"""Fetch stats from each queue API concurrently, waiting at most
+		pollDeadline seconds for the whole cycle. A queue that misses the
+		deadline is reported as a failed connection. Its request is left
+		running and is waited on again next cycle rather than resubmitted.
+		"""
+		futures = []
+		for api in apis:
+			future = self.pendingPolls.get(api)
+			if future is None or future.done():
+				future = self.pollExecutor.submit(api.get_stats)
+				self.pendingPolls[api] = future
+			futures.append(future)
+		wait(futures, timeout=self.pollDeadline)
+		results = []
+		for api, future in zip(apis, futures):
+			if not future.done():
+				logger.warning('No response from {} within {} seconds.'.format(api.URL, self.pollDeadline))
+				results.append((None, None, None, True))
+				continue
+			del self.pendingPolls[api]
+			try:
+				results.append(future.result())
+			except Exception as e:
+				logger.warning('Received Exception polling {}: {}'.format(api.URL, e))
+				results.append((None, None, None, True))
+		return results
+	
 	def get_new_stats(self):
-		"""Get the latest stats from the queue API endpoints. Combine
-		phone and voicemail to show the total call number and longest
-		wait time.
+		"""Get the latest stats from all queue API endpoints and combine
+		them into agents ready, calls waiting and longest wait time using
+		the queueAggregation rules. Queues that could not be reached are
+		left out; the connection only counts as failed if all of them fail.
 		"""
-		phoneReady, phoneCalls, phoneTimeSeconds, phoneConnectFailed = self.callQueueAPI.get_stats()
-		vmReady, vmCalls, vmTimeSeconds, vmConnectFailed = self.voicemailQueueAPI.get_stats()
-		connectFailed = phoneConnectFailed and vmConnectFailed
-		if connectFailed:
-			ready = None
-			calls = None
-			timeSeconds = None
-		elif vmConnectFailed:
-			ready = phoneReady
-			calls = phoneCalls
-			timeSeconds = phoneTimeSeconds
-		elif phoneConnectFailed:
-			ready = vmReady
-			calls = vmCalls
-			timeSeconds = vmTimeSeconds
-		else:
-			ready = phoneReady
-			calls = phoneCalls + vmCalls
-			timeSeconds = max(phoneTimeSeconds, vmTimeSeconds)
-		return ready, calls, timeSeconds, connectFailed
-	
-	def calculate_points(self, calls, waitTime):
-		"""Determine call system priority points based on # of calls waiting
-		and wait time of longest waiting call.
+		results = self.poll_queues(self.queueAPIs)
+		answered = [(queue, stats) for queue, stats in zip(self.queues, results) if not stats[3]]
+		if not answered:
+			return None, None, None, True
+		ready = self.aggregate('ready', [(queue, stats[0]) for queue, stats in answered])
+		calls = self.aggregate('calls', [(queue, stats[1]) for queue, stats in answered])
+		timeSeconds = self.aggregate('waitTime', [(queue, stats[2]) for queue, stats in answered])
+		return ready, calls, timeSeconds, False
+	
+	def aggregate(self, metric, values):
+		"""Combine the values of metric from several queues."""
+		return aggregation_rules[self.aggregation[metric]](values)
+	
+	def calculate_points(self, calls, waitTime, ready=0):
+		"""Determine call system priority points based on # of calls waiting,
+		wait time of longest waiting call and agents ready, weighted as 
+		configured in rules.
 		"""
-		callPoints = calls
-		timePoints = waitTime // 60
-		return callPoints + timePoints
+		return self.rules.points(calls, waitTime, ready)
 	
 	def determine_state(self, ready, points, connectionFailure):
 		"""Choose the Hue light state based on the point count and whether the 
-		connection has been lost.
+		connection has been lost, using the bands configured in rules.
 		"""
 		if connectionFailure:
 			return self.states['noConnect']
-		elif points == 0 and ready:
-			return self.states['blue']
-		elif points == 0:
-			return self.states['green']
-		elif points >  0 and points < 4:
-			return self.states['greenYellow']
-		elif points >= 4 and points < 7:
-			return self.states['yellow']
-		elif points >= 7 and points < 9:
-			return self.states['orange']
-		elif points >= 9:
-			return self.states['red']
+		return self.states[self.rules.state(points, ready)]
 		
 	def is_operating_hours(self):
-		"""Determines whether the the time is currently during office hours.
+		"""Determines whether the the time is currently during office hours,
+		as configured in operatingHours.
 
 		Returns boolean True or False.
 		"""
-		isWeekday 	= (0  <= time.localtime()[6] <  5)	# checks if today is a weekday
-		is7to7		= (7  <= time.localtime()[3] < 19)	# checks if currently between 7am and 7pm
-		is11to8		= (11 <= time.localtime()[3] < 21)	# checks if currently between 11am and 8pm
-		return (isWeekday and is7to7) or (not isWeekday and is11to8)
+		return self.operatingHours.is_open()
+	
+	def next_interval(self, interval):
+		"""Poll faster while points are rising or within a point of changing
+		the lights, and back off gradually while the queue stays empty. 
+		Standby sleeps until the office opens."""
+		if self.standby:
+			untilOpen = self.operatingHours.next_transition() - time.time()
+			return min(max(untilOpen, 1), self.maxStandbyInterval)
+		if self.failCount or self.points is None:
+			self.interval = interval
+		elif (self.lastPoints is not None and self.points > self.lastPoints) or \
+				any(threshold - 1 <= self.points < threshold for threshold in self.rules.thresholds()):
+			self.interval = self.minInterval
+		elif self.points == 0 and self.lastPoints == 0:
+			self.interval = min(max(self.interval, interval) * 2, self.maxInterval)
+		else:
+			self.interval = interval
+		return self.interval
+	
+	def state_name(self, state):
+		"""Returns the lightStates name of state."""
+		for name, candidate in self.states.items():
+			if candidate is state:
+				return name
+		return 'unknown'
+	
+	def apply_state(self, state, force=False):
+		"""Passes state to the controller, without waiting for the Bridge
+		if asyncLightDispatch is set."""
+		if self.asyncDispatch:
+			self.controller.dispatch(state, force)
+		elif self.controller.set_state(state, force):
+			self.first_light()
+	
+	def first_light(self):
+		"""Logs the time from program start to the first state reaching the
+		lights, once."""
+		if self.firstLightSeconds is None:
+			self.firstLightSeconds = time.monotonic() - START_TIME
+			FIRST_LIGHT_SECONDS.set(self.firstLightSeconds, floor=self.name)
+			logger.info('First light state sent {:.3f} seconds after start.'.format(self.firstLightSeconds))
+	
+	def dispatched(self, state, applied, seconds):
+		"""Called from the dispatcher thread once state has been sent."""
+		if applied:
+			self.appliedState = state
+			self.first_light()
+		else:
+			logger.debug('Lights not set to {}, state {} after {:.3f} seconds.'.format(
+				self.state_name(state), self.state_name(self.appliedState), seconds))
 	
 	def heartbeat(self):
-		"""Re-issues a set_state command every 10 seconds to ensure that lights 
+		"""Re-issues the full state every 10 seconds to ensure that lights 
 		stay updated."""
 		if (time.time() - self.tic) > 10:
 			self.tic = time.time()
+			if self.bridgePending or self.tic >= self.bridgeSyncDue:
+				self.sync_bridge()
 			logger.debug('Heartbeat: refreshing state.')
-			self.controller.set_state(self.state)
+			self.apply_state(self.state, force=True)
+		else:
+			self.controller.reapply()
 	
 	def execute(self):
 		"""Main function. Calls the get_phone_data, calculate_points, and determine_state 
 		functions.  Then passes the selected state to the hue controller."""
+		self.check_config()
 		if not self.is_operating_hours():
-			logger.info('Not during office hours. Lights off.')
-			self.state = self.states['allOff']
-			self.controller.set_state(self.state)
-			self.standby = True
-			time.sleep(10)
+			if not self.standby:
+				logger.info('Not during office hours. Lights off.')
+				self.state = self.states['allOff']
+				self.apply_state(self.state)
+				self.standby = True
 			return self.standby
 		if self.standby:
 			self.state = self.states['allOn']
-			self.controller.set_state(self.state)
+			self.apply_state(self.state)
 			self.standby = False
 			return self.standby
 		points = 0
 		ready, calls, timeSeconds, connectFailed = self.get_new_stats()
+		self.mark('fetch')
+		if self.profiler is not None:
+			# decoding ran on the poll threads, as part of fetch
+			self.profiler.record('parse', sum(api.decodeSeconds for api in self.queueAPIs))
 		if connectFailed:
 			self.failCount += 1
+			if self.failSince is None:
+				self.failSince = time.monotonic()
 		else:
-			points = self.calculate_points(calls, timeSeconds)
+			points = self.calculate_points(calls, timeSeconds, ready)
 			self.failCount = 0
-		connectionFailure = self.failCount * self.checkInterval >= self.maxDisconnectTime
+			self.failSince = None
+		self.lastPoints, self.points = self.points, points
+		FAIL_COUNT.set(self.failCount, floor=self.name)
+		POINTS.set(points, floor=self.name)
+		# the interval varies, so measure the outage from the first failure
+		connectionFailure = self.failSince is not None and \
+			time.monotonic() - self.failSince + self.checkInterval >= self.maxDisconnectTime
 		newState = self.determine_state(ready, points, connectionFailure)
+		self.mark('score')
 		if newState != self.state:
 			self.state = newState
+			STATE_TRANSITIONS.inc(floor=self.name, state=self.state_name(newState))
 			logger.debug('Setting state: {}'.format(str(self.state)))
-			self.controller.set_state(self.state)
+			self.apply_state(self.state)
 		else:
 			self.heartbeat()
+		self.mark('dispatch')
 		return self.standby
 	
 	def reset_lights(self):
 		"""Action to be performed when the program is terminated.  Turns off the lights."""
 		try:
 			self.state = self.states['allOff']
-			self.controller.set_state(self.state)
+			self.apply_state(self.state)
+			self.controller.flush(timeout=5)
 		except:
 			pass
 			
-if __name__ == '__main__':
-	controller = huecontroller.HueController(
-		ip=config['manualBridgeIP'], username='ositechsupport')
-	monitor = PhoneStatusMonitor(controller)
+def floor_settings(config=None):
+	"""Returns the settings for each floor: the config (default: the loaded
+	one) with the floor's own entries (bridge, queues, light states, ...) 
+	applied on top. Without any 'floors' the config itself describes a 
+	single floor.
+	
+	A floor without a 'name' is named after its position, 'floor 1' and
+	so on: the name keys its Bridge in the discovery cache and prefixes
+	its scenes and schedules on the Bridge."""
+	if config is None:
+		config = get_config()
+	if not config['floors']:
+		return [config]
+	floors = []
+	for index, floor in enumerate(config['floors']):
+		settings = dict(config)
+		settings['name'] = 'floor {}'.format(index + 1)
+		settings.update(floor)
+		floors.append(settings)
+	return floors
+
+monitors = []
+
+def start_profiling(cycles=50):
+	"""Profiles the next cycles execute() cycles of every floor."""
+	for monitor in monitors:
+		monitor.start_profiling(cycles)
+
+def profile_route(query):
+	"""/profile?cycles=N on the metrics server starts profiling; /profile
+	without arguments returns the last reports."""
+	if 'cycles' in query:
+		cycles = int(query['cycles'][0])
+		start_profiling(cycles)
+		return 'Profiling the next {} cycles.\n'.format(cycles)
+	return '\n\n'.join('{}\n{}'.format(monitor.name or 'monitor', monitor.lastProfile or 'No profile yet.')
+		for monitor in monitors) + '\n'
+
+def run_floor(settings, scheduler, watcher=None, floor=0):
+	"""Connect to one floor's Bridge and monitor its queues.
+	
+	Until the Bridge answers, connecting is tried again after the 
+	bridgeBreaker's resetTimeout, doubling up to its maxResetTimeout, so an
+	unreachable Bridge leaves only its own floor dark until it is back. 
+	With --stop there is a single attempt."""
+	breaker = CircuitBreaker.from_config('bridge ' + settings.get('name', settings['manualBridgeIP'] or ''),
+		settings['bridgeBreaker'])
+	delay = breaker.minResetTimeout
+	while True:
+		try:
+			controller = huecontroller.HueController(
+				ip=settings['manualBridgeIP'], username=settings.get('username', 'ositechsupport'),
+				scheduler=scheduler, connectTimeout=settings['bridgeConnectTimeout'],
+				readTimeout=settings['bridgeReadTimeout'], breaker=breaker,
+				cachePath=settings['bridgeCacheFile'], cacheKey=settings.get('name', 'default'))
+			break
+		except ConnectionError as e:
+			if STOP:
+				logger.critical('{}: {}'.format(breaker.name, e))
+				return
+			logger.error('{}: {} Trying again in {} seconds.'.format(breaker.name, e, delay))
+			time.sleep(delay)
+			delay = min(delay * 2, breaker.maxResetTimeout)
+	monitor = PhoneStatusMonitor(controller, settings, watcher, floor)
+	monitors.append(monitor)
 	if STOP:
-		monitor.controller.set_state(monitor.states['allOff'])
+		if monitor.controller.set_state(monitor.states['allOff']):
+			monitor.first_light()
 	else:
 		monitor.run_forever(interval=monitor.checkInterval)
-	
-	
-		
-		
\ No newline at end of file
+
+def main(argv=None):
+	"""Entry point: reads the command line and config, then runs each floor."""
+	global config, STOP
+	args = set(sys.argv if argv is None else argv)
+	if '-d' in args or '--debug' in args:
+		logging.basicConfig(level=logging.DEBUG)
+	elif '-i' in args or '--info' in args:
+		logging.basicConfig(level=logging.INFO)
+	else:
+		logging.basicConfig(level=logging.INFO)
+	STOP = '--stop' in args
+	# These two needed for Negotiate auth to work after being build by 
+	# pyinstaller, which also finds imports made inside functions
+	try:
+		from multiprocessing import Queue
+		import win32timezone
+	except ImportError:
+		pass
+	config = load_config()
+	logger.debug('Configuration loaded {:.3f} seconds after start.'.format(time.monotonic() - START_TIME))
+	# Floors share one command scheduler (and the connection pools in phue),
+	# but each runs in its own thread so a slow Bridge only delays its floor.
+	scheduler = phue.CommandScheduler()
+	if config['metricsPort']:
+		server = metrics.start_http_server(config['metricsPort'])
+		server.routes['/profile'] = profile_route
+	# SIGUSR1, or Ctrl+Break on Windows, profiles the next profileCycles cycles
+	profileSignal = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+	if profileSignal is not None:
+		signal.signal(profileSignal, lambda signum, frame: start_profiling(config['profileCycles']))
+	watcher = ConfigWatcher('config.json', read_config, config, config['configCheckInterval'])
+	floors = floor_settings()
+	if len(floors) == 1:
+		run_floor(floors[0], scheduler, watcher)
+	else:
+		threads = []
+		for i, settings in enumerate(floors):
+			thread = threading.Thread(target=run_floor, args=(settings, scheduler, watcher, i),
+				name=settings['name'])
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+		try:
+			while any(thread.is_alive() for thread in threads):
+				for thread in threads:
+					thread.join(1)
+		except KeyboardInterrupt:
+			logger.warning('Keyboard interrupt detected, stopping.')
+
+if __name__ == '__main__':
+	main()
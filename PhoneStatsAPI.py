@@ -1,64 +1,214 @@
-import calendar
 import logging
-import json
-import requests
-from requests_negotiate_sspi import HttpNegotiateAuth
 import time
-import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import huedata
+import metrics
+from circuitbreaker import CircuitBreaker
 
 logger = logging.getLogger('PhoneStatsAPI')
 #logging.basicConfig(level=logging.DEBUG)
 
 MAX_STALE = 15 # Max allowable staleness in TSDATA response
+CONNECT_TIMEOUT = 2 # Seconds to wait for the TCP connection to TSDATA
+READ_TIMEOUT = 5 # Seconds to wait between bytes of the response
+HEDGE_MIN_SAMPLES = 20 # Latencies needed before hedging starts
+
+GET_STATS_SECONDS = metrics.registry.histogram('phone_stats_get_seconds',
+	'Time taken by PhoneStatsAPI.get_stats.', ('url',))
+CONNECT_FAILURES = metrics.registry.counter('phone_stats_failures_total',
+	'Polls of a queue that returned no usable data.', ('url',))
+STALE_RESPONSES = metrics.registry.counter('phone_stats_stale_total',
+	'Responses rejected because the crawled data was stale.', ('url',))
+HEDGED_REQUESTS = metrics.registry.counter('phone_stats_hedged_total',
+	'Second requests sent because the first was slower than the hedge quantile.', ('url',))
 
 class PhoneStatsAPI:
-	def __init__(self, URL, timeout=MAX_STALE):
+	def __init__(self, URL, timeout=MAX_STALE, connectTimeout=CONNECT_TIMEOUT, readTimeout=READ_TIMEOUT,
+			hedgeQuantile=None, breaker=None):
+		"""timeout : staleness limit of the crawled data, in seconds
+		connectTimeout, readTimeout : HTTP deadlines, in seconds
+		hedgeQuantile : float, optional
+			If given (e.g. 0.95), a second request is sent when the first
+			takes longer than this quantile of recent latencies, and the
+			first response wins.
+		breaker : CircuitBreaker, optional
+			Defaults to a breaker for this URL with the default settings."""
 		self.URL = URL
 		self.timeout = timeout
-		self.session = requests.Session()
-		self.session.auth = HttpNegotiateAuth()
+		self.httpTimeout = (connectTimeout, readTimeout)
+		self.hedgeQuantile = hedgeQuantile
+		self.latencies = deque(maxlen=100)
+		self.breaker = breaker or CircuitBreaker(URL)
+		# Idle sessions. A hedged request, or one still running when the next
+		# poll starts, takes a session (and connection) of its own. The
+		# first is made on the first poll, see new_session.
+		self.sessions = []
+		self.sessionLock = threading.Lock()
+		self.requestExecutor = None
+		# Validators and decoded data of the last good response, used to make
+		# conditional requests and to answer a 304 Not Modified
+		self.etag = None
+		self.lastModified = None
+		self.snapshot = None
+		self.decodeSeconds = 0
+		
+	def new_session(self):
+		# requests is imported on first use, it takes longer to import than
+		# the rest of the program
+		import requests
+		from requests_negotiate_sspi import HttpNegotiateAuth
+		session = requests.Session()
+		session.auth = HttpNegotiateAuth()
+		return session
+		
+	def get(self, headers):
+		"""GET the URL on an idle session, recording the latency."""
+		with self.sessionLock:
+			session = self.sessions.pop() if self.sessions else self.new_session()
+		try:
+			tic = time.monotonic()
+			response = session.get(self.URL, headers=headers, timeout=self.httpTimeout)
+			self.latencies.append(time.monotonic() - tic)
+			return response
+		finally:
+			with self.sessionLock:
+				self.sessions.append(session)
+		
+	def hedge_delay(self):
+		"""Returns the seconds after which to send a hedged request, or None
+		if hedging is off or there are too few latencies to go by."""
+		if self.hedgeQuantile is None or len(self.latencies) < HEDGE_MIN_SAMPLES:
+			return None
+		latencies = sorted(self.latencies)
+		return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedgeQuantile))]
+		
+	def request(self):
+		"""GET the URL, hedging if the response is slow. Takes at most the
+		hedge delay plus the HTTP timeouts of the hedged request."""
+		headers = self.conditional_headers()
+		delay = self.hedge_delay()
+		if delay is None:
+			return self.get(headers)
+		if self.requestExecutor is None:
+			self.requestExecutor = ThreadPoolExecutor(max_workers=4)
+		first = self.requestExecutor.submit(self.get, headers)
+		done, pending = wait([first], timeout=delay)
+		if done:
+			return first.result()
+		logger.debug('No response after {:.3f} seconds, sending hedged request.'.format(delay))
+		HEDGED_REQUESTS.inc(url=self.URL)
+		pending = {first, self.requestExecutor.submit(self.get, headers)}
+		while True:
+			done, pending = wait(pending, return_when=FIRST_COMPLETED)
+			succeeded = [future for future in done if future.exception() is None]
+			if succeeded:
+				# the first success wins; the other request finishes on its own
+				return succeeded[0].result()
+			if not pending:
+				return done.pop().result()
+		
+	def conditional_headers(self):
+		headers = {}
+		if self.snapshot is not None:
+			if self.etag is not None:
+				headers['If-None-Match'] = self.etag
+			if self.lastModified is not None:
+				headers['If-Modified-Since'] = self.lastModified
+		return headers
+		
+	def decode(self, content):
+		"""Decodes the huedata JSON into a snapshot of the queue. The earliest
+		queue time is kept as epoch seconds so that the wait time can be
+		recomputed without the response."""
+		ready, calls, earliest = huedata.decode(content)
+		snapshot = {'ready': ready, 'calls': calls, 'earliest': earliest, 'crawlTime': None}
+		logger.debug(snapshot)
+		return snapshot
 		
 	def get_stats(self):
+		"""Returns (ready, calls, timeInQueue, connectFailed) for the queue.
+		While the circuit breaker is open, returns a failed connection
+		without making a request."""
+		if not self.breaker.allow():
+			logger.debug('Circuit breaker open for {}, skipping request.'.format(self.URL))
+			CONNECT_FAILURES.inc(url=self.URL)
+			return None, None, None, True
+		tic = time.monotonic()
+		try:
+			stats = self.fetch_stats()
+		except:
+			self.breaker.record_failure()
+			raise
+		GET_STATS_SECONDS.observe(time.monotonic() - tic, url=self.URL)
+		if stats[3]:
+			CONNECT_FAILURES.inc(url=self.URL)
+		return stats
+		
+	def fetch_stats(self):
 		logger.debug('Accessing source URL...')
+		self.decodeSeconds = 0
 		try:
-			response = self.session.get(self.URL)
+			response = self.request()
 		except:
-			# exception means general connection issue to machine URL
+			# exception means general connection issue to machine URL, or timeout
 			logger.warning('CANNOT CONNECT TO PHONE QUEUE STATUS PAGE')
 			logger.warning('URL: {} Check network connection and destination URL.'.format(self.URL))
+			self.breaker.record_failure()
 			return None, None, None, True
-		if not response.ok:
+		notModified = response.status_code == 304 and self.snapshot is not None
+		if not notModified and (not response.ok or response.status_code == 304):
 			# Bad status means connection succeeded but something wrong with machine
 			logger.warning('Bad status ' + str(response.status_code) + ' received.')
+			self.breaker.record_failure()
 			return None, None, None, True
+		# the server answered; stale or unparseable data is not its fault
+		self.breaker.record_success()
 		if 'X-Crawl-Stale-Seconds' in response.headers:
 			logger.debug("'X-Crawl-Stale-Seconds': " + response.headers['X-Crawl-Stale-Seconds'])
 			if int(response.headers['X-Crawl-Stale-Seconds']) > self.timeout:
 				logger.warning('Response data stale: ' + response.headers['X-Crawl-Stale-Seconds'] + ' seconds')
+				STALE_RESPONSES.inc(url=self.URL)
 				return None, None, None, True
-		else:
+		elif not notModified:
 			logger.warning("'X-Crawl-Stale-Seconds' header missing from HTTP response")
+		crawlTime = None
 		if 'X-Crawl-Timestamp' in response.headers:
 			logger.debug("'X-Crawl-Timestamp': " + response.headers['X-Crawl-Timestamp'])
-			crawlTime = calendar.timegm(datetime.datetime.strptime(response.headers['X-Crawl-Timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
+			try:
+				crawlTime = huedata.parse_timestamp(response.headers['X-Crawl-Timestamp'])
+			except ValueError:
+				logger.warning('Parse error on X-Crawl-Timestamp')
+				return None, None, None, True
+		elif notModified:
+			crawlTime = self.snapshot['crawlTime']
+		if crawlTime is not None:
 			staleSeconds = time.time() - crawlTime
 			logger.debug("Stale time: " + str(staleSeconds))
 			if staleSeconds > self.timeout:
 				logger.warning('Response data stale: ' + str(staleSeconds) + ' seconds')
+				STALE_RESPONSES.inc(url=self.URL)
 				return None, None, None, True
-		logger.debug('Success.')
-		try:
-			data = json.loads(response.content.decode('utf-8'))
-			logger.debug(data)
-			calls = data['queueCount']
-			ready = data['agentsAvailable']
-			earliestStr = data['earliestQueueTime']
-			if earliestStr is not None:
-				earliest = calendar.timegm(datetime.datetime.strptime(earliestStr, '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
-				timeInQueue = time.time() - earliest
-			else:
-				timeInQueue = 0
-			return int(ready), int(calls), timeInQueue, False
-		except:
-			logger.warning('Parse error on returned data')
-			return None, None, None, True
\ No newline at end of file
+		if notModified:
+			logger.debug('Not modified, reusing last response.')
+			snapshot = self.snapshot
+			snapshot['crawlTime'] = crawlTime
+		else:
+			logger.debug('Success.')
+			try:
+				tic = time.perf_counter()
+				snapshot = self.decode(response.content)
+				self.decodeSeconds = time.perf_counter() - tic
+			except:
+				logger.warning('Parse error on returned data')
+				return None, None, None, True
+			snapshot['crawlTime'] = crawlTime
+			self.snapshot = snapshot
+			self.etag = response.headers.get('ETag')
+			self.lastModified = response.headers.get('Last-Modified')
+		if snapshot['earliest'] is not None:
+			timeInQueue = time.time() - snapshot['earliest']
+		else:
+			timeInQueue = 0
+		return snapshot['ready'], snapshot['calls'], timeInQueue, False
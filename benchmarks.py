@@ -0,0 +1,103 @@
+"""
+benchmarks
+
+Microbenchmarks for the HueVisualAlert hot paths. Run with the name of a
+benchmark, or no arguments to run them all:
+
+	python benchmarks.py decode
+"""
+
+import calendar
+import datetime
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import huedata
+
+def bench_decode(number=20000):
+	"""Compares decoding a huedata payload and its crawl timestamp with the
+	json.loads + strptime path against huedata.decode/parse_timestamp."""
+	payload = b'{"queueCount": 3, "agentsAvailable": 1, "earliestQueueTime": "2017-09-12T14:03:27.513Z"}'
+	crawlTimestamp = '2017-09-12T14:05:01.250Z'
+	
+	def legacy():
+		data = json.loads(payload.decode('utf-8'))
+		calendar.timegm(datetime.datetime.strptime(crawlTimestamp, '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
+		calendar.timegm(datetime.datetime.strptime(data['earliestQueueTime'], '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
+		return int(data['agentsAvailable']), int(data['queueCount'])
+	
+	def fast():
+		huedata.parse_timestamp(crawlTimestamp)
+		return huedata.decode(payload)
+	
+	def uncached():
+		huedata.parse_timestamp.cache_clear()
+		huedata.parse_timestamp(crawlTimestamp)
+		return huedata.decode(payload)
+	
+	results = [
+		('json + strptime', timeit.timeit(legacy, number=number)),
+		('huedata, cached', timeit.timeit(fast, number=number)),
+		('huedata, uncached', timeit.timeit(uncached, number=number))
+	]
+	baseline = results[0][1]
+	print('Decode huedata payload and crawl timestamp ({} runs)'.format(number))
+	for name, seconds in results:
+		print('  {:<20} {:8.2f} us/call  {:6.1f}x'.format(name, seconds / number * 1e6, baseline / seconds))
+
+def bench_startup(runs=10):
+	"""Measures the cost of starting HueVisualAlert in a fresh interpreter:
+	importing each module, and the time to first light of 
+	'HueVisualAlert.py --stop' (load config, connect, turn the lights off)
+	as logged by the program itself. Runs in a temporary directory so the
+	config and Bridge cache files are created from defaults."""
+	here = os.path.dirname(os.path.abspath(__file__))
+	env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get('PYTHONPATH')])))
+	workdir = tempfile.mkdtemp()
+	
+	def median_seconds(args):
+		times = []
+		for i in range(runs):
+			tic = time.perf_counter()
+			subprocess.run([sys.executable] + args, cwd=workdir, env=env, check=True,
+				stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+			times.append(time.perf_counter() - tic)
+		return statistics.median(times)
+	
+	try:
+		interpreter = median_seconds(['-c', 'pass'])
+		print('Startup cost over a bare interpreter ({:.1f} ms), median of {} runs'.format(interpreter * 1000, runs))
+		for module in ('huedata', 'businesshours', 'metrics', 'phue', 'PhoneStatsAPI', 'huecontroller', 'HueVisualAlert'):
+			seconds = median_seconds(['-c', 'import ' + module])
+			print('  import {:<16} {:8.1f} ms'.format(module, (seconds - interpreter) * 1000))
+		firstLight = []
+		for i in range(runs):
+			output = subprocess.run([sys.executable, os.path.join(here, 'HueVisualAlert.py'), '--stop'],
+				cwd=workdir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.decode()
+			match = re.search(r'First light state sent ([\d.]+) seconds', output)
+			if match is None:
+				print('  time to first light: not reached, output was:\n' + output)
+				return
+			firstLight.append(float(match.group(1)))
+		print('  {:<23} {:8.1f} ms (after imports of HueVisualAlert started)'.format(
+			'time to first light', statistics.median(firstLight) * 1000))
+	finally:
+		shutil.rmtree(workdir)
+
+benchmarks = {
+	'decode': bench_decode,
+	'startup': bench_startup
+}
+
+if __name__ == '__main__':
+	names = sys.argv[1:] or sorted(benchmarks)
+	for name in names:
+		benchmarks[name]()
@@ -0,0 +1,112 @@
+"""
+businesshours
+
+Operating hours calendar for HueVisualAlert. Opening hours are given per
+day of the week, as a list of ["HH:MM", "HH:MM"] windows in local time
+("24:00" ends a window at midnight), and holidays as "YYYY-MM-DD" dates
+on which the office is closed all day:
+
+	{
+		"monday": [["07:00", "19:00"]],
+		...
+		"sunday": [["11:00", "21:00"]],
+		"holidays": ["2017-12-25"]
+	}
+"""
+
+import datetime
+import time
+
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+MINUTES_PER_WEEK = 7 * 1440
+
+def parse_minutes(hhmm):
+	"""Converts 'HH:MM' to minutes after midnight. '24:00' is allowed."""
+	hours, minutes = hhmm.split(':')
+	value = int(hours) * 60 + int(minutes)
+	if not 0 <= value <= 24 * 60 or not 0 <= int(minutes) < 60:
+		raise ValueError('Invalid time of day: {}'.format(hhmm))
+	return value
+
+def local_epoch(date, minutes):
+	"""Epoch seconds of minutes after local midnight on date."""
+	date = date + datetime.timedelta(days=minutes // 1440)
+	minutes = minutes % 1440
+	return time.mktime((date.year, date.month, date.day, minutes // 60, minutes % 60, 0, 0, 0, -1))
+
+class OperatingHours(object):
+
+	"""Weekly opening windows and holidays, compiled into transition times.
+
+	The open or closed span containing the current time is computed once,
+	as a pair of epoch times. Until the span ends, is_open() and
+	next_transition() only compare against those times.
+
+	"""
+
+	def __init__(self, weekly, holidays=()):
+		"""weekly : dict of day name to list of (start, end) 'HH:MM' pairs
+		holidays : iterable of 'YYYY-MM-DD' dates"""
+		self.windows = []
+		for day in DAYS:
+			windows = sorted((parse_minutes(start), parse_minutes(end)) for start, end in weekly.get(day, []))
+			for start, end in windows:
+				if start >= end:
+					raise ValueError('Window ends before it starts on {}: {}'.format(day, (start, end)))
+			self.windows.append(windows)
+		self.holidays = set(datetime.datetime.strptime(date, '%Y-%m-%d').date() for date in holidays)
+		self.span = (0, 0, False)
+
+	@classmethod
+	def from_config(cls, hours):
+		"""Builds the calendar from the 'operatingHours' config entry."""
+		return cls(dict((day, hours.get(day, [])) for day in DAYS), hours.get('holidays', []))
+
+	def open_spans(self, first, days):
+		"""Yields (start, end) epoch times of the open windows on each of the
+		given number of days from date first, merging windows that touch."""
+		current = None
+		for offset in range(days):
+			date = first + datetime.timedelta(days=offset)
+			if date in self.holidays:
+				continue
+			for start, end in self.windows[date.weekday()]:
+				start, end = local_epoch(date, start), local_epoch(date, end)
+				if current is not None and start <= current[1]:
+					current = (current[0], max(current[1], end))
+					continue
+				if current is not None:
+					yield current
+				current = (start, end)
+		if current is not None:
+			yield current
+
+	def compile_span(self, now):
+		"""Returns (start, end, isOpen) for the open or closed span containing now."""
+		today = datetime.date.fromtimestamp(now)
+		closedSince = now - 86400
+		for start, end in self.open_spans(today - datetime.timedelta(days=1), 9):
+			if now < start:
+				return (closedSince, start, False)
+			if now < end:
+				return (start, end, True)
+			closedSince = end
+		# no opening within the next week, look again tomorrow
+		return (closedSince, now + 86400, False)
+
+	def update(self, now):
+		if not self.span[0] <= now < self.span[1]:
+			self.span = self.compile_span(now)
+		return self.span
+
+	def is_open(self, now=None):
+		"""Returns True if now (default: the current time) is during opening hours."""
+		if now is None:
+			now = time.time()
+		return self.update(now)[2]
+
+	def next_transition(self, now=None):
+		"""Returns the epoch time of the next opening or closing after now."""
+		if now is None:
+			now = time.time()
+		return self.update(now)[1]
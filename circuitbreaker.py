@@ -0,0 +1,103 @@
+"""
+circuitbreaker
+
+A circuit breaker for calls to a service that may be down, so that a
+dead endpoint costs a check of the clock instead of a timed out request:
+
+	breaker = CircuitBreaker('tsdata')
+	if breaker.allow():
+		try:
+			...
+		except IOError:
+			breaker.record_failure()
+		else:
+			breaker.record_success()
+
+After failureThreshold consecutive failures the breaker opens and allow()
+returns False for resetTimeout seconds. The next call is then let through
+as a trial: success closes the breaker, failure opens it again for twice
+as long, up to maxResetTimeout.
+"""
+
+import logging
+import threading
+import time
+import metrics
+
+logger = logging.getLogger('circuitbreaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+BREAKER_OPEN = metrics.registry.gauge('circuit_breaker_open',
+	'1 while the circuit breaker is open or half-open, 0 while closed.', ('breaker',))
+BREAKER_REJECTED = metrics.registry.counter('circuit_breaker_rejected_total',
+	'Calls short-circuited by an open circuit breaker.', ('breaker',))
+
+class CircuitBreaker(object):
+
+	"""Tracks consecutive failures of a service and stops calls to it
+	while it is known to be down. Safe to share between threads."""
+
+	def __init__(self, name, failureThreshold=3, resetTimeout=5, maxResetTimeout=300):
+		self.name = name
+		self.failureThreshold = failureThreshold
+		self.minResetTimeout = resetTimeout
+		self.maxResetTimeout = maxResetTimeout
+		self.resetTimeout = resetTimeout
+		self.state = CLOSED
+		self.failures = 0
+		self.openedAt = None
+		self.lock = threading.Lock()
+		BREAKER_OPEN.set(0, breaker=name)
+
+	@classmethod
+	def from_config(cls, name, settings):
+		"""Builds a breaker from a dict with any of failureThreshold,
+		resetTimeout and maxResetTimeout."""
+		return cls(name, **dict((key, settings[key]) for key in
+			('failureThreshold', 'resetTimeout', 'maxResetTimeout') if key in settings))
+
+	def allow(self):
+		"""Returns True if a call should be made. Once resetTimeout has passed
+		on an open breaker, one trial call is allowed at a time."""
+		with self.lock:
+			if self.state == CLOSED:
+				return True
+			if self.state == OPEN and time.monotonic() - self.openedAt >= self.resetTimeout:
+				logger.info('{}: trying again after {} seconds.'.format(self.name, self.resetTimeout))
+				self.state = HALF_OPEN
+				return True
+		BREAKER_REJECTED.inc(breaker=self.name)
+		return False
+
+	def record_success(self):
+		with self.lock:
+			if self.state != CLOSED:
+				logger.info('{}: recovered, closing circuit breaker.'.format(self.name))
+				BREAKER_OPEN.set(0, breaker=self.name)
+			self.state = CLOSED
+			self.failures = 0
+			self.resetTimeout = self.minResetTimeout
+
+	def record_failure(self):
+		with self.lock:
+			self.failures += 1
+			if self.state == HALF_OPEN:
+				# trial call failed, back off
+				self.resetTimeout = min(self.resetTimeout * 2, self.maxResetTimeout)
+			elif self.state == OPEN or self.failures < self.failureThreshold:
+				return
+			logger.warning('{}: {} consecutive failures, not trying again for {} seconds.'.format(
+				self.name, self.failures, self.resetTimeout))
+			self.state = OPEN
+			self.openedAt = time.monotonic()
+			BREAKER_OPEN.set(1, breaker=self.name)
+
+	def remaining(self):
+		"""Seconds until an open breaker allows a trial call, 0 otherwise."""
+		with self.lock:
+			if self.state != OPEN:
+				return 0
+			return max(0, self.resetTimeout - (time.monotonic() - self.openedAt))
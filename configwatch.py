@@ -0,0 +1,74 @@
+"""
+configwatch
+
+Reloads a configuration file while the program runs. The file is only
+read when its modification time or size has changed, which costs one
+stat() per check:
+
+	watcher = ConfigWatcher('config.json', read_config, config)
+	...
+	config = watcher.check()
+
+The loader is expected to raise ValueError (or OSError) for a file that
+cannot be used; the previous configuration is then kept, so a half
+written or mistyped file never replaces a working one. Other exceptions
+from the loader are logged and treated the same way.
+"""
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('configwatch')
+
+class ConfigWatcher(object):
+
+	"""Keeps the latest valid configuration loaded from a file. Safe to
+	share between threads."""
+
+	def __init__(self, path, load, config=None, interval=1):
+		"""path : string
+		load : callable(path) returning the configuration
+		config : the configuration already loaded from path, if any
+		interval : float, minimum seconds between checks of the file"""
+		self.path = path
+		self.load = load
+		self.config = config
+		self.interval = interval
+		self.signature = self.stat() if config is not None else None
+		self.lastCheck = time.monotonic()
+		self.lock = threading.Lock()
+
+	def stat(self):
+		"""Returns (modification time, size) of the file, or None."""
+		try:
+			result = os.stat(self.path)
+		except OSError:
+			return None
+		return result.st_mtime_ns, result.st_size
+
+	def check(self):
+		"""Returns the current configuration, reloading the file first if it
+		changed. A file that fails to load is reported once, until it
+		changes again."""
+		with self.lock:
+			now = time.monotonic()
+			if now - self.lastCheck < self.interval:
+				return self.config
+			self.lastCheck = now
+			signature = self.stat()
+			if signature is None or signature == self.signature:
+				return self.config
+			self.signature = signature
+			try:
+				config = self.load(self.path)
+			except (OSError, ValueError) as e:
+				logger.warning('Not reloading {}, keeping the previous configuration: {}'.format(self.path, e))
+				return self.config
+			except Exception as e:
+				logger.exception('Error loading {}, keeping the previous configuration: {}'.format(self.path, e))
+				return self.config
+			logger.info('Reloaded {}.'.format(self.path))
+			self.config = config
+			return config
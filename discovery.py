@@ -0,0 +1,174 @@
+"""
+discovery
+
+Finds the Hue Bridge for HueVisualAlert. Candidates are tried in order,
+stopping at the first that answers:
+
+	1. the manually configured IP, if any
+	2. the last good IP, from the discovery cache file
+	3. bridges answering an SSDP (UPnP) M-SEARCH on the local network
+	4. the meethue.com nupnp service
+
+Each candidate is checked with a single GET /api/<username>/config. The
+IP and username that worked are saved to the cache file, so a restart
+normally costs one request to the Bridge and nothing outside the office
+network.
+"""
+
+import http.client
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlparse
+
+logger = logging.getLogger('discovery')
+
+# floors find their Bridges in parallel threads, but share the cache file
+cacheLock = threading.Lock()
+
+CACHE_FILE = 'bridge.json'
+SSDP_ADDRESS = ('239.255.255.250', 1900)
+NUPNP_URL = 'http://www.meethue.com/api/nupnp'
+
+SEARCH_REQUEST = '\r\n'.join([
+	'M-SEARCH * HTTP/1.1',
+	'HOST: {}:{}',
+	'MAN: "ssdp:discover"',
+	'MX: {}',
+	'ST: ssdp:all',
+	'', ''])
+
+def load_cache(path=CACHE_FILE, key='default'):
+	"""Returns the cached {'ip': ..., 'username': ...} for key, or {}."""
+	try:
+		with open(path) as f:
+			return json.loads(f.read()).get(key, {})
+	except (OSError, ValueError, AttributeError):
+		return {}
+
+def save_cache(ip, username, path=CACHE_FILE, key='default'):
+	"""Records ip and username as the last good Bridge for key."""
+	with cacheLock:
+		try:
+			with open(path) as f:
+				cache = json.loads(f.read())
+		except (OSError, ValueError):
+			cache = {}
+		if not isinstance(cache, dict):
+			cache = {}
+		if cache.get(key) == {'ip': ip, 'username': username}:
+			return
+		cache[key] = {'ip': ip, 'username': username}
+		# write then rename, so a crash never leaves half a file; the
+		# temporary file is per process, in case several share the cache
+		temp = '{}.{}.tmp'.format(path, os.getpid())
+		try:
+			with open(temp, mode='w') as f:
+				f.write(json.dumps(cache, indent=4))
+			os.replace(temp, path)
+		except OSError as e:
+			logger.warning('Could not write discovery cache {}: {}'.format(path, e))
+
+def validate(ip, username, timeout=2):
+	"""Returns (reachable, registered) for a Bridge at ip. Only a whitelisted
+	username gets the full config, including 'whitelist', back."""
+	# http.client rather than urllib.request, which takes longer to import
+	# than the request itself
+	connection = http.client.HTTPConnection(ip, timeout=timeout)
+	try:
+		connection.request('GET', '/api/{}/config'.format(username))
+		data = json.loads(str(connection.getresponse().read(), encoding='utf-8'))
+	except (OSError, ValueError, http.client.HTTPException) as e:
+		logger.debug('No Bridge at {}: {}'.format(ip, e))
+		return False, False
+	finally:
+		connection.close()
+	if not isinstance(data, dict):
+		return False, False
+	return True, 'whitelist' in data
+
+def ssdp_search(timeout=2, address=SSDP_ADDRESS, mx=1):
+	"""Sends an SSDP M-SEARCH and returns the addresses of the Hue Bridges
+	that answer within timeout seconds, in the order they answered."""
+	found = []
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+	try:
+		sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+		sock.sendto(SEARCH_REQUEST.format(address[0], address[1], mx).encode('ascii'), address)
+		deadline = time.monotonic() + timeout
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			sock.settimeout(remaining)
+			try:
+				data, sender = sock.recvfrom(2048)
+			except socket.timeout:
+				break
+			headers = {}
+			for line in data.decode('latin-1').split('\r\n')[1:]:
+				key, _, value = line.partition(':')
+				headers[key.strip().lower()] = value.strip()
+			# Hue Bridges identify themselves in the SERVER header
+			if 'IpBridge' not in headers.get('server', '') and 'hue-bridgeid' not in headers:
+				continue
+			location = urlparse(headers.get('location', ''))
+			host = location.netloc or sender[0]
+			if host.endswith(':80'):
+				host = host[:-3]
+			if host not in found:
+				found.append(host)
+	except OSError as e:
+		logger.warning('SSDP search failed: {}'.format(e))
+	finally:
+		sock.close()
+	return found
+
+def nupnp_search(timeout=5, url=NUPNP_URL):
+	"""Asks the meethue.com nupnp service for the Bridges registered from
+	this network's public address."""
+	import urllib.request
+	try:
+		with urllib.request.urlopen(url, timeout=timeout) as connection:
+			data = json.loads(str(connection.read(), encoding='utf-8'))
+		return [str(bridge['internalipaddress']) for bridge in data]
+	except (OSError, ValueError, KeyError, TypeError) as e:
+		logger.warning('nupnp search failed: {}'.format(e))
+		return []
+
+def find_bridge(username=None, ip=None, cachePath=CACHE_FILE, key='default', timeout=2,
+		ssdpAddress=SSDP_ADDRESS, nupnpURL=NUPNP_URL):
+	"""Returns (ip, username) of the Bridge to use, or (None, username) if
+	none answered. username defaults to the cached one.
+
+	Of the bridges found by a search, one that knows username is preferred
+	over one that would need it registered."""
+	cached = load_cache(cachePath, key)
+	username = username or cached.get('username')
+	tried = set()
+	def first_reachable(candidates):
+		reachable = None
+		for candidate in candidates:
+			if not candidate or candidate in tried:
+				continue
+			tried.add(candidate)
+			isReachable, isRegistered = validate(candidate, username, timeout)
+			if isRegistered:
+				return candidate
+			if isReachable and reachable is None:
+				reachable = candidate
+		return reachable
+	for source, search in (
+			('configured', lambda: [ip]),
+			('cached', lambda: [cached.get('ip')]),
+			('SSDP', lambda: ssdp_search(timeout, ssdpAddress)),
+			('nupnp', lambda: nupnp_search(timeout, nupnpURL))):
+		found = first_reachable(search())
+		if found is not None:
+			logger.info('Using {} Bridge IP: {}'.format(source, found))
+			return found, username
+	logger.warning('Could not find a Hue Bridge.')
+	return None, username
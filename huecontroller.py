@@ -13,19 +13,127 @@ Philips Electronics N.V. See www.meethue.com for more information.
 """
 
 
-import urllib.request
 import atexit
+import datetime
+import hashlib
 import time
+import threading
 import json
 import re
 import warnings
 import logging
+import metrics
+import discovery
+from circuitbreaker import CircuitBreaker, CLOSED
 try: 
 	import phue
 except:
 	exit('The phue module must be installed. Visit https://github.com/studioimaginaire/phue')
 
 logger = logging.getLogger('huecontroller')
+
+EXECUTE_SECONDS = metrics.registry.histogram('monitor_execute_seconds',
+	'Duration of one execute() cycle.', ('monitor',))
+TICK_LATENESS = metrics.registry.histogram('monitor_tick_lateness_seconds',
+	'How late execute() cycles start compared to their schedule.', ('monitor',),
+	buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+BRIDGE_REQUEST_SECONDS = metrics.registry.histogram('hue_bridge_request_seconds',
+	'Latency of requests to the Hue Bridge.', ('bridge', 'method'))
+BRIDGE_REQUEST_FAILURES = metrics.registry.counter('hue_bridge_request_failures_total',
+	'Requests to the Hue Bridge that raised an exception.', ('bridge',))
+DISPATCH_SECONDS = metrics.registry.histogram('light_dispatch_seconds',
+	'Time from HueController.dispatch() until the state was sent to the Bridge.')
+DISPATCH_SUPERSEDED = metrics.registry.counter('light_dispatch_superseded_total',
+	'Dispatched states replaced by a newer one before they were sent.')
+
+
+class LightState(dict):
+	
+	"""A light state (dict of Bridge attributes) with its JSON encoding
+	prepared once. encode() builds the body for any subset of the 
+	attributes by joining the pre-encoded members, so set_state does not 
+	serialise the same states over and over. Treat it as read-only.
+	
+	An optional 'lights' entry, {light id: attributes}, overrides the 
+	attributes of single lights. Only Bridge scenes can show those, see
+	HueController.sync_scenes; without a scene all lights get the common
+	attributes.
+	
+	"""
+	
+	def __init__(self, *args, **kwargs):
+		dict.__init__(self, *args, **kwargs)
+		self.perLight = self.get('lights', {})
+		self.members = dict((key, json.dumps(key) + ': ' + json.dumps(value)) 
+			for key, value in self.items() if key != 'lights')
+		self.body = self.encode(self.members)
+		# id of the Bridge scene holding this state, set by sync_scenes
+		self.scene = None
+		
+	def encode(self, keys):
+		"""Returns the JSON request body (bytes) setting the given attributes."""
+		return ('{' + ', '.join(self.members[key] for key in keys) + '}').encode('utf-8')
+		
+	def light_states(self, lights):
+		"""Returns {light id: attributes} for the given light ids."""
+		common = dict((key, value) for key, value in self.items() if key != 'lights')
+		return dict((light, dict(common, **self.perLight.get(light, {}))) for light in lights)
+
+
+class CycleProfiler(object):
+	
+	"""Collects per-phase timings of a number of execute() cycles. 
+	
+	A monitor calls mark(phase) as each phase of execute() ends; the time 
+	since the previous mark is charged to that phase. Times measured 
+	elsewhere (e.g. on a worker thread) can be added with record().
+	
+	"""
+	
+	def __init__(self, cycles):
+		self.remaining = cycles
+		# marks made before the first start_cycle() (profiling was started 
+		# part way through a cycle) are ignored
+		self.last = None
+		self.phases = {}
+		self.order = []
+		self.totals = []
+		
+	def start_cycle(self):
+		self.start = self.last = time.perf_counter()
+		
+	def record(self, phase, seconds):
+		if self.last is None:
+			return
+		if phase not in self.phases:
+			self.phases[phase] = []
+			self.order.append(phase)
+		self.phases[phase].append(seconds)
+		
+	def mark(self, phase):
+		if self.last is None:
+			return
+		now = time.perf_counter()
+		self.record(phase, now - self.last)
+		self.last = now
+		
+	def end_cycle(self):
+		"""Returns True once all requested cycles have been recorded."""
+		self.totals.append(time.perf_counter() - self.start)
+		self.remaining -= 1
+		return self.remaining <= 0
+		
+	def report(self):
+		"""Returns a table of the timings of each phase, in milliseconds."""
+		lines = ['{:<12}{:>8}{:>10}{:>10}{:>10}{:>10}'.format('phase', 'count', 'mean', 'p50', 'p95', 'max')]
+		for phase in self.order + ['cycle']:
+			samples = sorted(self.totals if phase == 'cycle' else self.phases[phase])
+			if not samples:
+				continue
+			lines.append('{:<12}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(phase, len(samples),
+				sum(samples) / len(samples) * 1000, samples[len(samples) // 2] * 1000,
+				samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, samples[-1] * 1000))
+		return '\n'.join(lines)
 	
 
 class BaseURLMonitor(object):
@@ -41,26 +149,74 @@ class BaseURLMonitor(object):
 		"""Constructor.  May be overridden."""		
 		self.controller = controller
 		self.standby = False
+		self.name = ''
+		self.tickJitter = {'ticks': 0, 'last': 0.0, 'mean': 0.0, 'max': 0.0}
+		self.profiler = None
+		self.lastProfile = None
 		
 	def execute(self):
 		"""Should be overridden by child class."""
 		logger.warning('execute() method has not been overriden!')
 		
+	def mark(self, phase):
+		"""Marks the end of a phase of execute() for the profiler. Costs a
+		single attribute check when not profiling."""
+		if self.profiler is not None:
+			self.profiler.mark(phase)
+		
+	def start_profiling(self, cycles=50):
+		"""Profiles the next cycles execute() cycles, then logs the report 
+		and keeps it in lastProfile. Safe to call from another thread or a 
+		signal handler; the loop keeps running."""
+		logger.info('Profiling the next {} cycles.'.format(cycles))
+		self.profiler = CycleProfiler(cycles)
+		
+	def next_interval(self, interval):
+		"""Returns the seconds until the next execute(), given the base 
+		interval passed to run_forever. May be overridden to poll faster or
+		slower depending on what the last execute() saw."""
+		return interval
+		
+	def record_jitter(self, lateness):
+		"""Records how late a tick started compared to its deadline."""
+		jitter = self.tickJitter
+		jitter['ticks'] += 1
+		jitter['last'] = lateness
+		jitter['mean'] += (lateness - jitter['mean']) / jitter['ticks']
+		jitter['max'] = max(jitter['max'], lateness)
+		TICK_LATENESS.observe(lateness, monitor=self.name)
+		
 	def run_forever(self, interval=None):
-		"""Run execute() method repeatedly with delay defined by the 
-		checkInterval attribute"""
+		"""Run execute() method repeatedly, next_interval() seconds apart.
+		
+		Ticks are scheduled on the monotonic clock from the previous tick's
+		deadline, so they neither drift nor jump with the wall clock. If 
+		execute() overruns, the schedule restarts from now instead of running
+		the missed ticks back to back. tickJitter holds how late ticks start."""
 		if interval:
 			checkInterval = interval
 		else:
 			checkInterval = 15
 		try:
 			logger.info('Running forever. Hit ^C to interrupt.')
+			deadline = time.monotonic()
 			while True:
-				tic = time.time()
-				self.standby = self.execute()
-				toc = time.time()
-				if (not self.standby) and (toc - tic) < checkInterval:	
-					time.sleep(checkInterval - (toc - tic))
+				self.record_jitter(time.monotonic() - deadline)
+				profiler = self.profiler
+				if profiler is not None:
+					profiler.start_cycle()
+				with EXECUTE_SECONDS.time(monitor=self.name):
+					self.standby = self.execute()
+				if profiler is not None and profiler.end_cycle():
+					self.profiler = None
+					self.lastProfile = profiler.report()
+					logger.info('Profile of {} cycles:\n{}'.format(len(profiler.totals), self.lastProfile))
+				deadline += self.next_interval(checkInterval)
+				now = time.monotonic()
+				if deadline > now:
+					time.sleep(deadline - now)
+				else:
+					deadline = now
 		except KeyboardInterrupt:
 			logger.warning('Keyboard interrupt detected, stopping.')
 
@@ -68,55 +224,90 @@ class HueController(object):
 	
 	"""Main controller object. """
 	
-	def __init__(self, ip=None, username=None):
+	def __init__(self, ip=None, username=None, scheduler=None, connectTimeout=2, readTimeout=5, breaker=None,
+			cachePath=discovery.CACHE_FILE, cacheKey='default'):
 		""" Initialization function.
 		
 		ip : string (dotted quad), optional
 		userName : string, optional
+		scheduler : phue.CommandScheduler, optional
+		connectTimeout, readTimeout : float, optional
+		breaker : circuitbreaker.CircuitBreaker, optional
+		cachePath, cacheKey : string, optional
+			File and entry in it remembering the last Bridge that worked
+		
+		Light commands are paced through the given scheduler, which may be
+		shared with other controllers. A private one is created if none is
+		given.
 		
-		Will attempt to find Bridge IP automatically and connect.  Will 
-		attempt to use given userName first if present.  If not, will 
-		default to "newdeveloper".
+		Requests to the Bridge give up after the given timeouts. After 
+		repeated failures the breaker stops sending commands for a while; 
+		the last state asked for is applied once the Bridge answers again.
+		
+		set_state blocks until the Bridge answers; dispatch() hands the 
+		state to a worker thread instead.
+		
+		Will use the given IP if the Bridge answers there, else the cached
+		one, else find the Bridge automatically (see discovery), and 
+		connect.  Will attempt to use given userName first if present, 
+		then the cached one.  If neither, will default to "newdeveloper".
 		
 		Once connected, instruct Bridge to search for new lights using 
-		get_new_lights().
+		get_new_lights(). Raises ConnectionError if no Bridge answered.
 		"""
 		pass
+		self.dispatcher = None
+		self.dispatchCallback = None
+		self.dispatchCondition = threading.Condition()
+		# (state, force, monotonic time dispatched) waiting to be sent
+		self.dispatchSlot = None
+		# (function, callback) to run on the dispatcher thread, see call_soon
+		self.dispatchTasks = []
+		self.dispatchBusy = False
+		# held while the Bridge's lights, scenes or schedules are changed
+		self.bridgeLock = threading.RLock()
 		# self.IP = ip
 		# self.userName = username
 		# self.hue = None
+		# self.cachePath = cachePath
+		# self.cacheKey = cacheKey
+		# # names of this floor's scenes and schedules on the Bridge start with
+		# # a fixed length prefix, so that any floor name fits in their 32
+		# # characters and no floor can match another's
+		# self.bridgePrefix = 'VA {} '.format(hashlib.sha1(cacheKey.encode('utf-8')).hexdigest()[:6])
+		# self.scheduler = scheduler or phue.CommandScheduler()
+		# self.connectTimeout = connectTimeout
+		# self.readTimeout = readTimeout
+		# self.breaker = breaker or CircuitBreaker('bridge')
+		# self.desiredState = None
 		
+		# self.IP, self.userName = discovery.find_bridge(self.userName, ip, 
+			# self.cachePath, self.cacheKey, timeout=self.connectTimeout)
 		# if self.IP:
-			# logger.info('Using IP: {}'.format(self.IP))
 			# self.hue = self.connect(self.IP)
-			# if self.hue is None:
-				# logger.warning('Given IP failed. Finding IP automatically...')
-				# self.IP = self.get_bridge_IP()
-				# logger.info('Found IP: {}'.format(self.IP))
-				# self.hue = self.connect(self.IP)
-		# self.IP = self.get_bridge_IP()
-		# logger.info('Found IP: {}'.format(self.IP))
-		# self.hue = self.connect(self.IP)
 		
 		# if self.hue:
-			# pass
+			# discovery.save_cache(self.IP, self.userName, self.cachePath, self.cacheKey)
 			# self.get_new_lights()									
 		# else:
-			# logger.critical('Unable to connect to Bridge.')
-			# exit('Quitting.')
+			# raise ConnectionError('Unable to connect to Bridge.')
 
 	def connect(self, IP):
 		"""Attempts to connect to Bridge"""
 		pass
 		# if not self.userName: 
 			# self.userName = 'newdeveloper'
-		# hue = phue.Bridge(ip=IP, username=self.userName)
+		# hue = phue.Bridge(ip=IP, username=self.userName, scheduler=self.scheduler,
+			# connect_timeout=self.connectTimeout, read_timeout=self.readTimeout)
+		# hue.request_observers.append(self.observe_request)
 		# try:
-			# test = hue.get_api()
+			# # the config is all a username check needs, get_api() would
+			# # download every light and group
+			# test = hue.request('GET', '/api/' + self.userName + '/config')
 			# logger.info('Found Bridge at {0}'.format(IP))
-			# if isinstance(test, dict):
+			# if isinstance(test, dict) and 'whitelist' in test:
 				# return hue
-			# elif isinstance(test, list):
+			# elif isinstance(test, (dict, list)):
 				# logger.warning(
 					# 'Username unregistered. Attempting to register username "{}"'.format(
 						# self.userName))
@@ -131,27 +322,32 @@ class HueController(object):
 		# except: 
 			# return None
 	
+	def observe_request(self, mode, address, seconds, error):
+		"""Records the latency of each request made to the Bridge."""
+		BRIDGE_REQUEST_SECONDS.observe(seconds, bridge=self.IP, method=mode)
+		if error is not None:
+			BRIDGE_REQUEST_FAILURES.inc(bridge=self.IP)
+	
 	def get_bridge_IP(self):
 		"""Attempts to automatically find a Hue Bridge on the network.
 		
+		Bridges on the local network are found by SSDP.  Failing that, 
 		Hue Bridges automatically upload their IP address daily to a Philips
 		database.  Accessing http://www.meethue.com/api/nupnp returns a list 
 		of Hue Bridges connected to the network you are connecting from.
 		
+		Returns None if no Bridge was found.
 		"""
-		with urllib.request.urlopen('http://www.meethue.com/api/nupnp') as connection:
-			data = str(connection.read())
-		ipPatternCompiled = re.compile(r'(\d+\.\d+\.\d+\.\d+)')
-		match = ipPatternCompiled.search(data)
-		if match is None:
+		ip, self.userName = discovery.find_bridge(self.userName, cachePath=self.cachePath, 
+			key=self.cacheKey, timeout=self.connectTimeout)
+		if ip is None:
 			logger.warning('Could not find Bridge IP address automatically')
-			exit('Quitting.')
-		else: 
-			return match.group(1)
+		return ip
 			
 	def post_user(self):
 		"""Sends POST request to Hue Bridge to register a username and program."""
 		pass
+		# import urllib.request
 		# url = 'http://' + self.IP + '/api' 
 		# r = json.dumps({'devicetype':'Python Hue Controller', 'username':self.userName}).encode('utf-8')
 		# req = urllib.request.Request(url, data=r, method='POST')
@@ -194,22 +390,259 @@ class HueController(object):
 		"""
 		logger.info('Instructing Bridge to search for new lights.')
 		pass
-		# url = 'http://' + self.IP + '/api/' + self.userName + '/lights'
-		# req = urllib.request.Request(url, method='POST')
-		# with urllib.request.urlopen(req) as connection:
-			# response = connection.read()
+		# # over the Bridge's keep-alive connection, which set_state reuses
+		# response = self.hue.request('POST', '/api/' + self.userName + '/lights')
 		# logger.debug(response)
-		# connection.close()
 		
-	def set_state(self, state):
-		"""Accepts a state (type: dictionary) and applies it to all Hue lights."""
+	def sync_scenes(self, states):
+		"""Keeps a Bridge scene for each of states (dict of name: LightState)
+		and sets the states' scene ids, so that set_state recalls a scene 
+		with one small request instead of sending every attribute.
+		
+		Scenes are named after the state, behind the floor's bridgePrefix, 
+		and carry a digest of their light states in appdata. A scene whose 
+		digest still matches is reused, any other is replaced, and scenes of
+		states no longer configured are deleted. Returns False if the Bridge
+		could not be asked; states without a scene are sent as attributes.
+		
+		The Bridge is asked without holding bridgeLock, so set_state is not
+		held up. The lock is only taken to set the new scene ids, before 
+		the scenes they replace are deleted."""
+		pass
+		# if self.hue is None or not self.breaker.allow():
+			# return False
+		# prefix = self.bridgePrefix
+		# try:
+			# lights = sorted(self.hue.request('GET', '/api/' + self.userName + '/lights'), key=int)
+			# if not lights:
+				# logger.warning('No lights found, not creating scenes.')
+				# self.breaker.record_success()
+				# return False
+			# existing = self.hue.get_scene()
+			# stale = [sceneId for sceneId, scene in existing.items() if scene.get('name', '').startswith(prefix)]
+			# scenes = {}
+			# for name, state in sorted(states.items()):
+				# lightStates = state.light_states(lights)
+				# digest = hashlib.sha1(json.dumps(lightStates, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+				# sceneName = (prefix + name)[:32]
+				# scenes[name] = None
+				# for sceneId in stale:
+					# scene = existing[sceneId]
+					# if scene['name'] == sceneName and scene.get('appdata', {}).get('data') == digest:
+						# stale.remove(sceneId)
+						# scenes[name] = sceneId
+						# break
+				# if scenes[name] is not None:
+					# continue
+				# logger.info('Creating scene "{}".'.format(sceneName))
+				# response = self.hue.create_scene(sceneName, lights, lightStates, {'version': 1, 'data': digest})
+				# if 'success' in response[0]:
+					# scenes[name] = response[0]['success']['id']
+				# else:
+					# logger.warning('Could not create scene "{}": {}'.format(sceneName, response))
+			# with self.bridgeLock:
+				# for name, state in states.items():
+					# state.scene = scenes[name]
+			# for sceneId in stale:
+				# logger.info('Deleting scene "{}".'.format(existing[sceneId]['name']))
+				# self.hue.delete_scene(sceneId)
+		# except Exception as e:
+			# self.breaker.record_failure()
+			# logger.error('Could not update scenes, {}'.format(e))
+			# return False
+		# self.breaker.record_success()
+		# return True
+		return True
+	
+	def action(self, state):
+		"""Returns the group action setting state, recalling its scene if it
+		has one."""
+		if getattr(state, 'scene', None) is not None:
+			return {'scene': state.scene}
+		return dict((key, value) for key, value in state.items() if key != 'lights')
+	
+	def sync_schedules(self, operatingHours, onState, offState, days=14):
+		"""Programs the Bridge to set the lights to onState when the office
+		opens and to offState when it closes (operatingHours is a 
+		businesshours.OperatingHours), so they follow the operating hours
+		even while this program is not running.
+		
+		Every opening and closing in the next days days gets a one-off 
+		schedule for its date, so holidays simply have none. The Bridge 
+		deletes them once they have run; calling this again (the monitor 
+		does daily) extends the schedules to cover the days ahead. Schedules
+		of this floor (named behind its bridgePrefix, which leaves room for 
+		the label and date) that are no longer wanted are deleted. Returns 
+		False if the Bridge could not be asked.
+		
+		As in sync_scenes, bridgeLock is only held to read the states' scene
+		ids, not while the Bridge is asked."""
+		pass
+		# if self.hue is None or not self.breaker.allow():
+			# return False
+		# prefix = self.bridgePrefix
+		# with self.bridgeLock:
+			# actions = (('on', self.action(onState)), ('off', self.action(offState)))
+		# now = time.time()
+		# # from yesterday, in case the office opened then and is still open
+		# first = datetime.date.fromtimestamp(now) - datetime.timedelta(days=1)
+		# # (name, local time, group action)
+		# wanted = []
+		# for start, end in operatingHours.open_spans(first, days + 1):
+			# for at, (label, action) in zip((start, end), actions):
+				# if at <= now:
+					# continue
+				# localtime = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(at))
+				# wanted.append(('{}{} {}'.format(prefix, label, localtime[:16]), localtime, action))
+		# address = '/api/' + self.userName + '/groups/0/action'
+		# try:
+			# for scheduleId, schedule in sorted(self.hue.get_schedule().items()):
+				# if not schedule.get('name', '').startswith(prefix):
+					# continue
+				# command = schedule.get('command', {})
+				# key = (schedule['name'], schedule.get('localtime'), command.get('body'))
+				# if key in wanted and command.get('address') == address:
+					# wanted.remove(key)
+					# continue
+				# logger.info('Deleting schedule "{}" ({}).'.format(schedule['name'], schedule.get('localtime')))
+				# self.hue.delete_schedule(scheduleId)
+			# for name, localtime, action in wanted:
+				# logger.info('Creating schedule "{}" ({}).'.format(name, localtime))
+				# response = self.hue.create_group_schedule(name, localtime, 0, action, 
+					# 'HueVisualAlert operating hours', localtime=True)
+				# if 'success' not in response[0]:
+					# logger.warning('Could not create schedule "{}": {}'.format(name, response))
+		# except Exception as e:
+			# self.breaker.record_failure()
+			# logger.error('Could not update schedules, {}'.format(e))
+			# return False
+		# self.breaker.record_success()
+		# return True
+		return True
+	
+	def start_dispatcher(self, callback=None):
+		"""Starts the worker thread used by dispatch(). 
+		
+		callback : callable(state, applied, seconds), optional
+			Called on the worker thread after each state is sent, with 
+			whether set_state succeeded and the seconds since it was 
+			dispatched."""
+		if callback is not None:
+			self.dispatchCallback = callback
+		if self.dispatcher is not None:
+			return
+		self.dispatcher = threading.Thread(target=self.run_dispatcher, name='dispatcher')
+		self.dispatcher.daemon = True
+		self.dispatcher.start()
+		
+	def dispatch(self, state, force=False):
+		"""Hands state to the dispatcher thread and returns immediately. 
+		
+		Only the most recent state is kept: one that has not been sent yet 
+		is replaced (keeping force if either asked for it)."""
+		if self.dispatcher is None:
+			self.start_dispatcher()
+		with self.dispatchCondition:
+			if self.dispatchSlot is not None:
+				DISPATCH_SUPERSEDED.inc()
+				force = force or self.dispatchSlot[1]
+			self.dispatchSlot = (state, force, time.monotonic())
+			self.dispatchCondition.notify_all()
+			
+	def call_soon(self, function, callback=None):
+		"""Runs function() on the dispatcher thread, before the next state is
+		sent, and passes its result to callback there. For Bridge work that
+		should not hold up the caller, such as sync_scenes."""
+		if self.dispatcher is None:
+			self.start_dispatcher()
+		with self.dispatchCondition:
+			self.dispatchTasks.append((function, callback))
+			self.dispatchCondition.notify_all()
+			
+	def flush(self, timeout=None):
+		"""Waits until the dispatcher has sent the last state given to it. 
+		Returns False if that took longer than timeout seconds."""
+		if self.dispatcher is None:
+			return True
+		with self.dispatchCondition:
+			return self.dispatchCondition.wait_for(
+				lambda: self.dispatchSlot is None and not self.dispatchTasks and not self.dispatchBusy, timeout)
+		
+	def run_task(self, function, callback):
+		try:
+			result = function()
+			if callback is not None:
+				callback(result)
+		except Exception as e:
+			logger.error('Dispatcher task raised Exception, {}'.format(e))
+		
+	def run_dispatcher(self):
+		while True:
+			with self.dispatchCondition:
+				while self.dispatchSlot is None and not self.dispatchTasks:
+					self.dispatchCondition.wait()
+				self.dispatchBusy = True
+				# tasks first, they may prepare the Bridge for the next state
+				if self.dispatchTasks:
+					task = self.dispatchTasks.pop(0)
+				else:
+					task = None
+					state, force, dispatched = self.dispatchSlot
+					self.dispatchSlot = None
+			if task is not None:
+				self.run_task(*task)
+			else:
+				self.send_dispatched(state, force, dispatched)
+			with self.dispatchCondition:
+				self.dispatchBusy = False
+				self.dispatchCondition.notify_all()
+		
+	def send_dispatched(self, state, force, dispatched):
+		try:
+			applied = self.set_state(state, force)
+		except Exception as e:
+			logger.error('Dispatcher received Exception, {}'.format(e))
+			applied = False
+		seconds = time.monotonic() - dispatched
+		DISPATCH_SECONDS.observe(seconds)
+		if self.dispatchCallback is not None:
+			try:
+				self.dispatchCallback(state, applied, seconds)
+			except Exception as e:
+				logger.error('Dispatch callback raised Exception, {}'.format(e))
+		
+	def reapply(self):
+		"""Sends the last state asked for as soon as the circuit breaker 
+		allows a trial, rather than waiting for the next set_state call."""
+		pass
+		# if self.desiredState is not None and self.breaker.state != CLOSED and self.breaker.remaining() == 0:
+			# (self.dispatch if self.dispatcher is not None else self.set_state)(self.desiredState, force=True)
+		
+	def set_state(self, state, force=False):
+		"""Accepts a state (type: dictionary) and applies it to all Hue lights.
+		
+		Only attributes that differ from the last acknowledged state are sent,
+		and nothing is sent if none differ. force=True sends the full state,
+		e.g. to recover lights that were changed outside this program. A 
+		state with a Bridge scene (see sync_scenes) is set by recalling it.
+		
+		While the circuit breaker is open the state is only remembered, and
+		set_state returns immediately. Returns True if the lights were set 
+		(or already were), False otherwise."""
 		logger.debug('Setting lights to {}'.format(state))
 		pass
+		# self.desiredState = state
+		# if not self.breaker.allow():
+			# return False
 		# try:
 			# pass
-			# #response = self.hue.set_group(0, state)
+			# #response = self.hue.set_group_action(0, state, state.body if isinstance(state, LightState) else None)
 			# #logger.debug(response)
+			# #self.breaker.record_success()
 		# except Exception as e:
+			# self.breaker.record_failure()
 			# logger.error('Received Exception, {}'.format(e))
 			# logger.error('Unable to connect to Hue Bridge. Check network connection.')
+			# return False
+		return True
 	
@@ -0,0 +1,50 @@
+"""
+huedata
+
+Decoding of the huedata responses served by TSDATA for each phone queue:
+
+	{"queueCount": 3, "agentsAvailable": 1, "earliestQueueTime": "2017-09-12T14:03:27.513Z"}
+
+Most of the cost of handling a response was parsing its two timestamps
+with strptime. Timestamps are now parsed by a fixed-format pattern, and
+repeated ones (the crawl time between crawls, the earliest call until it
+is answered) come from a cache.
+"""
+
+import calendar
+import datetime
+import functools
+import json
+import re
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+_TIMESTAMP = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)\.\d{1,6}Z\Z', re.ASCII)
+_decoder = json.JSONDecoder()
+
+@functools.lru_cache(maxsize=256)
+def parse_timestamp(timestamp):
+	"""Converts a 'YYYY-MM-DDTHH:MM:SS.fffZ' UTC timestamp to epoch seconds.
+	The fraction is dropped, as the strptime().timetuple() path did."""
+	match = _TIMESTAMP.match(timestamp)
+	if match is None:
+		# strptime raises the same ValueError as before for bad input
+		return calendar.timegm(datetime.datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ').timetuple())
+	year, month, day, hour, minute, second = map(int, match.groups())
+	if hour > 23 or minute > 59 or second > 61:
+		raise ValueError('Invalid timestamp: {}'.format(timestamp))
+	# date() validates the year, month and day
+	days = datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL
+	return days * 86400 + hour * 3600 + minute * 60 + second
+
+def decode(content):
+	"""Decodes a huedata payload (bytes). Returns (ready, calls, earliest),
+	earliest being the epoch seconds of the longest waiting call or None.
+	Raises ValueError, KeyError or TypeError if the payload is not valid."""
+	data = _decoder.decode(content.decode('utf-8'))
+	earliestStr = data['earliestQueueTime']
+	if earliestStr is not None:
+		earliest = parse_timestamp(earliestStr)
+	else:
+		earliest = None
+	return int(data['agentsAvailable']), int(data['queueCount']), earliest
@@ -0,0 +1,235 @@
+"""
+metrics
+
+A small metrics registry for HueVisualAlert, exposed over HTTP in the
+Prometheus text format. Metrics are created through a Registry and
+updated with label values as keyword arguments:
+
+	requests = metrics.registry.counter('requests_total', 'Requests made.', ('url',))
+	requests.inc(url='http://tsdata/...')
+
+	latency = metrics.registry.histogram('request_seconds', 'Request latency.', ('url',))
+	with latency.time(url='http://tsdata/...'):
+		...
+
+start_http_server() serves the default registry at /metrics on a daemon
+thread.
+"""
+
+import logging
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+logger = logging.getLogger('metrics')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def escape(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+	pairs = ['{}="{}"'.format(name, escape(value)) for name, value in zip(names, values)]
+	if extra:
+		pairs.append(extra)
+	if not pairs:
+		return ''
+	return '{' + ','.join(pairs) + '}'
+
+def format_value(value):
+	if value == float('inf'):
+		return '+Inf'
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value)
+
+class Metric(object):
+
+	"""Base class for metrics. Holds one value per combination of label values."""
+
+	type = 'untyped'
+
+	def __init__(self, name, documentation, labelNames=()):
+		self.name = name
+		self.documentation = documentation
+		self.labelNames = tuple(labelNames)
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def key(self, labels):
+		if set(labels) != set(self.labelNames):
+			raise ValueError('{} expects labels {}, got {}'.format(self.name, self.labelNames, tuple(labels)))
+		return tuple(str(labels[name]) for name in self.labelNames)
+
+	def samples(self):
+		"""Yields (suffix, labelValues, extraLabel, value) tuples."""
+		with self.lock:
+			values = list(self.values.items())
+		for key, value in sorted(values):
+			yield '', key, '', value
+
+	def exposition(self):
+		lines = ['# HELP {} {}'.format(self.name, self.documentation.replace('\n', ' ')),
+			'# TYPE {} {}'.format(self.name, self.type)]
+		for suffix, key, extra, value in self.samples():
+			lines.append('{}{}{} {}'.format(self.name, suffix,
+				format_labels(self.labelNames, key, extra), format_value(value)))
+		return '\n'.join(lines)
+
+class Counter(Metric):
+
+	"""A value that only goes up, e.g. a number of failures."""
+
+	type = 'counter'
+
+	def inc(self, amount=1, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+
+	"""A value that can go up and down, e.g. a current fail count."""
+
+	type = 'gauge'
+
+	def set(self, value, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = value
+
+	def inc(self, amount=1, **labels):
+		key = self.key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+class Timer(object):
+
+	"""Context manager observing the seconds spent in its block."""
+
+	def __init__(self, histogram, labels):
+		self.histogram = histogram
+		self.labels = labels
+
+	def __enter__(self):
+		self.tic = time.monotonic()
+		return self
+
+	def __exit__(self, *exc):
+		self.histogram.observe(time.monotonic() - self.tic, **self.labels)
+
+class Histogram(Metric):
+
+	"""Counts observations (e.g. latencies) into cumulative buckets."""
+
+	type = 'histogram'
+
+	def __init__(self, name, documentation, labelNames=(), buckets=DEFAULT_BUCKETS):
+		Metric.__init__(self, name, documentation, labelNames)
+		self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+	def observe(self, value, **labels):
+		key = self.key(labels)
+		with self.lock:
+			counts = self.values.get(key)
+			if counts is None:
+				counts = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+			for i, bound in enumerate(self.buckets):
+				if value <= bound:
+					counts[0][i] += 1
+					break
+			counts[1] += value
+			counts[2] += 1
+
+	def time(self, **labels):
+		return Timer(self, labels)
+
+	def samples(self):
+		with self.lock:
+			values = [(key, (list(counts[0]), counts[1], counts[2])) for key, counts in self.values.items()]
+		for key, (buckets, total, count) in sorted(values):
+			cumulative = 0
+			for bound, bucketCount in zip(self.buckets, buckets):
+				cumulative += bucketCount
+				yield '_bucket', key, 'le="{}"'.format(format_value(float(bound))), cumulative
+			yield '_sum', key, '', total
+			yield '_count', key, '', count
+
+class Registry(object):
+
+	"""Collection of metrics. Asking for an existing name returns that metric."""
+
+	def __init__(self):
+		self.metrics = {}
+		self.lock = threading.Lock()
+
+	def get_or_create(self, cls, name, *args, **kwargs):
+		with self.lock:
+			metric = self.metrics.get(name)
+			if metric is None:
+				metric = self.metrics[name] = cls(name, *args, **kwargs)
+			elif not isinstance(metric, cls):
+				raise ValueError('Metric {} already registered as a {}'.format(name, metric.type))
+			return metric
+
+	def counter(self, name, documentation, labelNames=()):
+		return self.get_or_create(Counter, name, documentation, labelNames)
+
+	def gauge(self, name, documentation, labelNames=()):
+		return self.get_or_create(Gauge, name, documentation, labelNames)
+
+	def histogram(self, name, documentation, labelNames=(), buckets=DEFAULT_BUCKETS):
+		return self.get_or_create(Histogram, name, documentation, labelNames, buckets=buckets)
+
+	def exposition(self):
+		"""Returns all metrics in the Prometheus text format."""
+		with self.lock:
+			metrics = sorted(self.metrics.items())
+		return '\n'.join(metric.exposition() for name, metric in metrics) + '\n'
+
+registry = Registry()
+
+def start_http_server(port, address='127.0.0.1', registry=registry):
+	"""Serves registry at http://address:port/metrics from a daemon thread.
+	More routes can be added to the returned server's routes dict."""
+	# imported here: http.server costs more to import than the rest of
+	# HueVisualAlert, and is only needed when metrics are served
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+	class MetricsHandler(BaseHTTPRequestHandler):
+
+		"""Serves the routes of a MetricsServer. Each route is a function taking
+		the parsed query string and returning the response text."""
+
+		def do_GET(self):
+			url = urlparse(self.path)
+			route = self.server.routes.get(url.path)
+			if route is None:
+				self.send_error(404)
+				return
+			try:
+				body = route(parse_qs(url.query)).encode('utf-8')
+			except Exception as e:
+				logger.warning('Error serving {}: {}'.format(url.path, e))
+				self.send_error(500)
+				return
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			logger.debug(format % args)
+
+	class MetricsServer(ThreadingMixIn, HTTPServer):
+		daemon_threads = True
+
+	server = MetricsServer((address, port), MetricsHandler)
+	server.routes = {'/metrics': lambda query: registry.exposition()}
+	thread = threading.Thread(target=server.serve_forever, name='metrics')
+	thread.daemon = True
+	thread.start()
+	logger.info('Serving metrics at http://{}:{}/metrics'.format(address, server.server_address[1]))
+	return server
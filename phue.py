@@ -16,8 +16,12 @@ I am in no way affiliated with the Philips organization.
 
 import json
 import os
+from collections import OrderedDict
 import platform
+import socket
 import sys
+import threading
+import time
 if sys.version_info[0] > 2:
     PY3K = True
 else:
@@ -28,6 +32,12 @@ if PY3K:
 else:
     import httplib
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the futures backport, multi-target writes stay serial
+    ThreadPoolExecutor = None
+
 import logging
 logger = logging.getLogger('phue')
 
@@ -39,6 +49,18 @@ else:
 
 __version__ = '0.8'
 
+if hasattr(time, 'monotonic'):
+    _clock = time.monotonic
+else:
+    _clock = time.time
+
+
+# Requests that may be sent twice without changing the outcome. A POST
+# whose connection drops may already have created a resource on the bridge,
+# so it is always sent on a new connection rather than an idle one the
+# bridge may have closed.
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
 
 class PhueException(Exception):
 
@@ -51,6 +73,358 @@ class PhueRegistrationException(PhueException):
     pass
 
 
+class ConnectionPool(object):
+
+    """ Pool of persistent HTTP/1.1 connections to a single bridge
+
+    Connections are handed back to the pool after each request so that the
+    next command reuses the open socket instead of paying a new TCP
+    handshake. At most maxsize idle connections are kept, and connections
+    that have been idle for longer than idle_timeout seconds are evicted
+    rather than reused (the bridge drops idle sockets on its own).
+
+    """
+    def __init__(self, host, maxsize=2, idle_timeout=30):
+        self.host = host
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.stats = {'created': 0, 'reused': 0, 'reconnects': 0,
+                      'evicted': 0, 'discarded': 0}
+        self._idle = []  # (connection, last_used), most recent last
+        self._lock = threading.Lock()
+
+    def new_connection(self, reconnect=False):
+        """ reconnect : bool, counts the connection as replacing a dropped one """
+        with self._lock:
+            self.stats['created'] += 1
+            if reconnect:
+                self.stats['reconnects'] += 1
+        return httplib.HTTPConnection(self.host)
+
+    def acquire(self, reuse=True):
+        """ Returns a (connection, reused) tuple. reuse=False always opens a
+        new connection """
+        now = _clock()
+        with self._lock:
+            while self._idle and now - self._idle[0][1] >= self.idle_timeout:
+                self._idle.pop(0)[0].close()
+                self.stats['evicted'] += 1
+            if self._idle and reuse:
+                self.stats['reused'] += 1
+                return self._idle.pop()[0], True
+        return self.new_connection(), False
+
+    def release(self, connection):
+        """ Return a connection whose response has been fully read """
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((connection, _clock()))
+                return
+            self.stats['discarded'] += 1
+        connection.close()
+
+    def clear(self):
+        """ Close all idle connections """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, last_used in idle:
+            connection.close()
+
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+
+def get_connection_pool(host, maxsize=2, idle_timeout=30):
+    """ Returns the shared ConnectionPool for host, creating it if needed """
+    with _connection_pools_lock:
+        pool = _connection_pools.get(host)
+        if pool is None:
+            pool = ConnectionPool(host, maxsize, idle_timeout)
+            _connection_pools[host] = pool
+        return pool
+
+
+# Attributes that each select a different colour mode of a light
+COLOR_MODE_KEYS = ('xy', 'ct', 'hue')
+
+
+class TokenBucket(object):
+
+    """ Token bucket allowing rate events per second, in bursts of up to
+    capacity events """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = _clock()
+
+    def delay(self):
+        """ Seconds until a token is available, 0 if one is available now """
+        now = _clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class CommandFuture(object):
+
+    """ Result of a write submitted to a CommandScheduler """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        # writes queued up to this one when it was submitted
+        self.queued = 1
+
+    def done(self):
+        return self._event.is_set()
+
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def result(self, timeout=None):
+        """ Wait for the bridge's response and return it """
+        if not self._event.wait(timeout):
+            raise PhueException(None, 'Timed out waiting for the bridge')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class _SchedulerLane(object):
+
+    """ Queue and worker thread of a CommandScheduler for one bridge """
+
+    def __init__(self, bridge, light_rate, group_rate):
+        self.bridge = bridge
+        self.buckets = {'lights': TokenBucket(light_rate),
+                        'groups': TokenBucket(group_rate)}
+        # address -> (data, [futures], body encoded by the caller or None)
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(
+            target=self.run, name='phue-scheduler-' + str(bridge.ip))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, address, data, body=None):
+        future = CommandFuture()
+        with self.condition:
+            if not self.running:
+                future.set_exception(PhueException(None, 'Command scheduler stopped'))
+                return future
+            if address in self.pending:
+                merged, futures, _ = self.pending[address]
+                merged = dict(merged)
+                if any(key in data for key in COLOR_MODE_KEYS):
+                    # the newer colour replaces the older one, whatever its mode
+                    for key in COLOR_MODE_KEYS:
+                        merged.pop(key, None)
+                merged.update(data)
+                futures.append(future)
+                # the merged data no longer matches either body
+                self.pending[address] = (merged, futures, None)
+            else:
+                self.pending[address] = (dict(data), [future], body)
+            # writes to send up to and including this one
+            future.queued = list(self.pending).index(address) + 1
+            self.condition.notify()
+        return future
+
+    def _next(self):
+        """ Pop the oldest target whose bucket has a token, waiting for one
+        if necessary. Returns None once stopped. """
+        with self.condition:
+            while self.running:
+                wait = None
+                for address in self.pending:
+                    bucket = self.buckets['groups' if '/groups/' in address else 'lights']
+                    delay = bucket.delay()
+                    if delay == 0:
+                        bucket.take()
+                        data, futures, body = self.pending.pop(address)
+                        return address, data, futures, body
+                    if wait is None or delay < wait:
+                        wait = delay
+                self.condition.wait(wait)
+        return None
+
+    def run(self):
+        while True:
+            command = self._next()
+            if command is None:
+                return
+            address, data, futures, body = command
+            if body is None:
+                body = json.dumps(data)
+            try:
+                result = self.bridge.request('PUT', address, body)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(result)
+
+    def stop(self):
+        """ Stop the worker, failing the writes still queued """
+        with self.condition:
+            self.running = False
+            pending, self.pending = self.pending, OrderedDict()
+            self.condition.notify()
+        for data, futures, body in pending.values():
+            for future in futures:
+                future.set_exception(PhueException(None, 'Command scheduler stopped'))
+
+
+class CommandScheduler(object):
+
+    """ Paces light and group writes and coalesces superseded ones
+
+    The bridge starts dropping commands beyond roughly 10 light commands or
+    1 group command per second. Writes submitted here are queued per target
+    and sent at most at those rates (token buckets). A write to a target
+    that still has one queued is merged into it, newer attributes winning,
+    so only the latest state is sent and every caller gets its response.
+
+    One scheduler can be shared by several Bridges. Each bridge ip gets its
+    own queue and worker thread, so a slow bridge does not hold up others.
+
+        >>> scheduler = CommandScheduler()
+        >>> b = Bridge(ip='192.168.1.100', scheduler=scheduler)
+
+    """
+    def __init__(self, light_rate=10, group_rate=1):
+        self.light_rate = light_rate
+        self.group_rate = group_rate
+        self._lanes = {}
+        self._lock = threading.Lock()
+
+    def submit(self, bridge, address, data, body=None):
+        """ Queue a PUT of data (a dict) to address on bridge. body is data
+        already encoded as JSON, sent unless the write is merged with
+        another. Returns a CommandFuture for the bridge's response. """
+        with self._lock:
+            lane = self._lanes.get(bridge.ip)
+            if lane is None:
+                lane = _SchedulerLane(bridge, self.light_rate, self.group_rate)
+                self._lanes[bridge.ip] = lane
+        return lane.submit(address, data, body)
+
+    def stop(self, ip=None):
+        """ Stop the worker threads, or only the one for bridge ip. Writes
+        still queued are not sent, waiting callers get a PhueException. """
+        with self._lock:
+            if ip is None:
+                lanes, self._lanes = self._lanes, {}
+            else:
+                lane = self._lanes.pop(ip, None)
+                lanes = {ip: lane} if lane is not None else {}
+        for lane in lanes.values():
+            lane.stop()
+
+
+class StateCache(object):
+
+    """ Time-limited cache of light and group state read from the bridge
+
+    A single GET of /lights (or /groups) fills the entries for every light
+    (or group), so reading several properties of several lights costs one
+    request per ttl seconds. Items the bulk GET does not list, such as
+    group 0, are cached one by one with put(). Writes made through the
+    Bridge are merged into the cached entries; invalidate() drops them
+    explicitly.
+
+    """
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self._entries = {'lights': {}, 'groups': {}}
+        self._filled = {'lights': None, 'groups': None}
+        # time each item cached by put() was fetched
+        self._put = {'lights': {}, 'groups': {}}
+        # ids the bulk GET did not list, fetched on their own from then on
+        self._unlisted = {'lights': set(), 'groups': set()}
+        self._lock = threading.Lock()
+
+    def _expired(self, filled):
+        return filled is None or _clock() - filled >= self.ttl
+
+    def get(self, kind, item_id):
+        """ Returns the cached json for one light or group, or None if it
+        is missing or older than ttl """
+        item_id = str(item_id)
+        with self._lock:
+            filled = self._put[kind].get(item_id, self._filled[kind])
+            if self._expired(filled):
+                return None
+            return self._entries[kind].get(item_id)
+
+    def fresh(self, kind):
+        """ Returns True if the bulk GET of kind is younger than ttl """
+        with self._lock:
+            return not self._expired(self._filled[kind])
+
+    def put(self, kind, item_id, item):
+        """ Cache the result of a GET of a single light or group """
+        with self._lock:
+            self._entries[kind][str(item_id)] = item
+            self._put[kind][str(item_id)] = _clock()
+            self._unlisted[kind].add(str(item_id))
+
+    def unlisted(self, kind, item_id):
+        """ Returns True if item_id was missing from a bulk GET of kind """
+        with self._lock:
+            return str(item_id) in self._unlisted[kind]
+
+    def fill(self, kind, items):
+        """ Replace the entries of kind ('lights' or 'groups') with the
+        result of a bulk GET """
+        with self._lock:
+            self._entries[kind] = dict((str(k), v) for k, v in items.items())
+            self._filled[kind] = _clock()
+            self._put[kind] = {}
+
+    def update(self, kind, item_id, data, section=None):
+        """ Merge the attributes written to one item into its entry """
+        with self._lock:
+            entry = self._entries[kind].get(str(item_id))
+            if entry is None:
+                return
+            if section is not None:
+                entry = entry.setdefault(section, {})
+            for key, value in data.items():
+                if key != 'transitiontime':
+                    entry[key] = value
+
+    def invalidate(self, kind=None, item_id=None):
+        """ Drop cached state. With no arguments everything is dropped,
+        with kind only that collection, with an item_id only that item. """
+        with self._lock:
+            for k in ([kind] if kind is not None else list(self._entries)):
+                if item_id is None:
+                    self._entries[k] = {}
+                    self._filled[k] = None
+                    self._put[k] = {}
+                    self._unlisted[k] = set()
+                else:
+                    self._entries[k].pop(str(item_id), None)
+                    self._put[k].pop(str(item_id), None)
+
+
 class Light(object):
 
     """ Hue Light object
@@ -396,7 +770,9 @@ class Bridge(object):
 
 
     """
-    def __init__(self, ip=None, username=None):
+    def __init__(self, ip=None, username=None, pool_size=4, pool_idle_timeout=30,
+                 cache_ttl=1.0, scheduler=None, max_parallel=4,
+                 connect_timeout=5, read_timeout=10):
         """ Initialization function.
 
         Parameters:
@@ -404,6 +780,24 @@ class Bridge(object):
         ip : string
             IP address as dotted quad
         username : string, optional
+        pool_size : int, optional
+            Number of idle keep-alive connections kept open to the bridge
+        pool_idle_timeout : float, optional
+            Seconds after which an idle connection is closed instead of reused
+        cache_ttl : float, optional
+            Seconds that light and group state read from the bridge is
+            served from memory; 0 or None reads through on every call
+        scheduler : CommandScheduler, optional
+            Paces and coalesces light and group state writes; without one
+            writes are sent immediately
+        max_parallel : int, optional
+            Number of lights or groups written to at the same time when
+            set_light or set_group is given a list; 1 sends them in turn
+        connect_timeout : float, optional
+            Seconds to wait for a TCP connection to the bridge; None waits
+            as long as the operating system does
+        read_timeout : float, optional
+            Seconds to wait for each read of a response; None waits forever
 
         """
 
@@ -418,6 +812,24 @@ class Bridge(object):
         self.lights_by_id = {}
         self.lights_by_name = {}
         self._name = None
+        self.scheduler = scheduler
+        # callables(mode, address, seconds, exception) run after every request
+        self.request_observers = []
+        self.max_parallel = max_parallel
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self.pool_size = pool_size
+        self.pool_idle_timeout = pool_idle_timeout
+        self._pool = None
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        if cache_ttl:
+            self.state_cache = StateCache(cache_ttl)
+        else:
+            self.state_cache = None
+        # name -> id indexes, None until first loaded from the bridge
+        self._light_ids_by_name = None
+        self._group_ids_by_name = None
 
         # self.minutes = 600 # these do not seem to be used anywhere?
         # self.seconds = 10
@@ -438,30 +850,189 @@ class Bridge(object):
         self.request(
             'PUT', '/api/' + self.username + '/config', json.dumps(data))
 
-    def request(self, mode='GET', address=None, data=None):
-        """ Utility function for HTTP GET/PUT requests for the API"""
-        connection = httplib.HTTPConnection(self.ip)
+    @property
+    def connection_pool(self):
+        '''The keep-alive ConnectionPool shared by all Bridges using this ip'''
+        if self._pool is None or self._pool.host != self.ip:
+            self._pool = get_connection_pool(
+                self.ip, self.pool_size, self.pool_idle_timeout)
+        return self._pool
+
+    @property
+    def connection_stats(self):
+        '''Counters for connections created, reused, reconnected and evicted'''
+        return dict(self.connection_pool.stats)
+
+    def _send(self, connection, mode, address, data):
+        if connection.sock is None:
+            connection.timeout = self.connect_timeout
+            connection.connect()
+        # the pool is shared, so apply this bridge's timeout on every use
+        connection.sock.settimeout(self.read_timeout)
         if mode == 'GET' or mode == 'DELETE':
             connection.request(mode, address)
         if mode == 'PUT' or mode == 'POST':
             connection.request(mode, address, data)
+        result = connection.getresponse()
+        # the body must be read completely before the connection is reused
+        return result, result.read()
+
+    def request(self, mode='GET', address=None, data=None):
+        """ Utility function for HTTP GET/PUT requests for the API"""
+        if not self.request_observers:
+            return self._request(mode, address, data)
+        tic = _clock()
+        error = None
+        try:
+            return self._request(mode, address, data)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            seconds = _clock() - tic
+            for observer in self.request_observers:
+                observer(mode, address, seconds, error)
+
+    def _request(self, mode, address, data):
+        pool = self.connection_pool
+        connection, reused = pool.acquire(mode in IDEMPOTENT_METHODS)
 
         logger.debug("{0} {1} {2}".format(mode, address, str(data)))
 
-        result = connection.getresponse()
-        connection.close()
+        try:
+            result, content = self._send(connection, mode, address, data)
+        except socket.timeout:
+            # a slow bridge is not a dropped socket, retrying would only
+            # double the wait
+            connection.close()
+            raise
+        except (httplib.HTTPException, socket.error):
+            connection.close()
+            if not reused:
+                raise
+            # The bridge closed the idle keep-alive socket, retry once on a
+            # fresh connection
+            logger.debug('Keep-alive connection dropped, reconnecting')
+            connection = pool.new_connection(reconnect=True)
+            try:
+                result, content = self._send(connection, mode, address, data)
+            except:
+                connection.close()
+                raise
+
+        if result.will_close:
+            connection.close()
+        else:
+            pool.release(connection)
         if PY3K:
-            return json.loads(str(result.read(), encoding='utf-8'))
+            return json.loads(str(content, encoding='utf-8'))
         else:
-            result_str = result.read()
-            logger.debug(result_str)
-            return json.loads(result_str)
+            logger.debug(content)
+            return json.loads(content)
+
+    def invalidate_cache(self, kind=None, item_id=None):
+        """ Drop cached light/group state, see StateCache.invalidate """
+        if self.state_cache is not None:
+            self.state_cache.invalidate(kind, item_id)
+
+    def _cached(self, kind, item_id):
+        """ Returns the cached json for a light or group, refreshing the
+        whole collection with one GET if it has expired. An item missing
+        from the collection (group 0 is never listed) is fetched and
+        cached on its own, now and from then on. Returns None if the cache is disabled or the
+        bridge returned an error. """
+        if self.state_cache is None:
+            return None
+        entry = self.state_cache.get(kind, item_id)
+        if entry is not None:
+            return entry
+        if not self.state_cache.fresh(kind) and not self.state_cache.unlisted(kind, item_id):
+            items = self.request('GET', '/api/' + self.username + '/' + kind + '/')
+            if isinstance(items, dict):
+                if kind == 'lights':
+                    self._index_lights(items)
+                else:
+                    self._index_groups(items)
+                self.state_cache.fill(kind, items)
+                entry = items.get(str(item_id))
+                if entry is not None:
+                    return entry
+        entry = self.request('GET', '/api/' + self.username + '/' + kind + '/' + str(item_id))
+        if not isinstance(entry, dict):
+            return None
+        self.state_cache.put(kind, item_id, entry)
+        return entry
+
+    def _index_lights(self, lights):
+        self._light_ids_by_name = dict(
+            (info['name'], light_id) for light_id, info in lights.items())
+
+    def _index_groups(self, groups):
+        self._group_ids_by_name = dict(
+            (info['name'], group_id) for group_id, info in groups.items())
+
+    def _rename(self, index, item_id, name):
+        """ Point name at item_id in a name index after a rename or create """
+        if index is None:
+            return
+        item_id = str(item_id)
+        for old_name, old_id in list(index.items()):
+            if old_id == item_id:
+                del index[old_name]
+        if name is not None:
+            index[name] = item_id
+
+    def _fan_out(self, send, targets):
+        """ Call send(target) for each target, up to max_parallel at a time,
+        and return the results in input order """
+        if len(targets) < 2 or self.max_parallel < 2 or ThreadPoolExecutor is None:
+            return [send(target) for target in targets]
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_parallel)
+            executor = self._executor
+        return list(executor.map(send, targets))
+
+    def close(self):
+        """ Stop the scheduler's worker for this bridge and the threads used
+        by set_light/set_group with a list. Writes still queued fail with a
+        PhueException. Both are started again when next needed. """
+        if self.scheduler is not None:
+            self.scheduler.stop(self.ip)
+        with self._executor_lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def _put_state(self, address, data, body=None):
+        """ PUT a light state or group action, through the scheduler if set.
+        body, if given, is data already encoded as JSON """
+        if self.scheduler is not None:
+            future = self.scheduler.submit(self, address, data, body)
+            timeout = None
+            if self.read_timeout is not None:
+                # each write queued up to this one may wait for its token
+                # (at worst the slower, group rate) and then for the bridge
+                timeout = future.queued * (1.0 / self.scheduler.group_rate +
+                                           (self.connect_timeout or 0) + self.read_timeout)
+            return future.result(timeout)
+        if body is None:
+            body = json.dumps(data)
+        return self.request('PUT', address, body)
+
+    def _cache_write(self, kind, item_id, data, section, response):
+        if self.state_cache is None:
+            return
+        if isinstance(response, list) and response and 'success' in response[0]:
+            self.state_cache.update(kind, item_id, data, section)
+        else:
+            self.state_cache.invalidate(kind, item_id)
 
     def get_ip_address(self, set_result=False):
 
         """ Get the bridge ip address from the meethue.com nupnp api """
 
-        connection = httplib.HTTPConnection('www.meethue.com')
+        connection = httplib.HTTPConnection('www.meethue.com', timeout=self.connect_timeout)
         connection.request('GET', '/api/nupnp')
 
         logger.info('Connecting to meethue.com/api/nupnp')
@@ -541,16 +1112,16 @@ class Bridge(object):
                 self.register_app()
 
     def get_light_id_by_name(self, name):
-        """ Lookup a light id based on string name. Case-sensitive. """
-        lights = self.get_light()
-        for light_id in lights:
-            if PY3K:
-                if name == lights[light_id]['name']:
-                    return light_id
-            else:
-                if unicode(name, encoding='utf-8') == lights[light_id]['name']:
-                    return light_id
-        return False
+        """ Lookup a light id based on string name. Case-sensitive.
+
+        Served from a name index kept current by renames through this
+        Bridge; an unknown name reloads the index from the bridge once. """
+        if not PY3K and not isinstance(name, unicode):
+            name = unicode(name, encoding='utf-8')
+        if self._light_ids_by_name is not None and name in self._light_ids_by_name:
+            return self._light_ids_by_name[name]
+        self.get_light()
+        return self._light_ids_by_name.get(name, False)
 
     def get_light_objects(self, mode='list'):
         """Returns a collection containing the lights, either by name or id (use 'id' or 'name' as the mode)
@@ -606,9 +1177,18 @@ class Bridge(object):
             if isinstance(light_id, str) or isinstance(light_id, unicode):
                 light_id = self.get_light_id_by_name(light_id)
         if light_id is None:
-            return self.request('GET', '/api/' + self.username + '/lights/')
-        state = self.request(
-            'GET', '/api/' + self.username + '/lights/' + str(light_id))
+            lights = self.request('GET', '/api/' + self.username + '/lights/')
+            if isinstance(lights, dict):
+                self._index_lights(lights)
+                if self.state_cache is not None:
+                    self.state_cache.fill('lights', lights)
+            return lights
+        state = None
+        if parameter is not None:
+            state = self._cached('lights', light_id)
+        if state is None:
+            state = self.request(
+                'GET', '/api/' + self.username + '/lights/' + str(light_id))
         if parameter is None:
             return state
         if parameter == 'name':
@@ -619,7 +1199,9 @@ class Bridge(object):
     def set_light(self, light_id, parameter, value=None, transitiontime=None):
         """ Adjust properties of one or more lights.
 
-        light_id can be a single lamp or an array of lamps
+        light_id can be a single lamp or an array of lamps. An array is
+        written to max_parallel lights at a time; results are returned in
+        the order of the array.
         parameters: 'on' : True|False , 'bri' : 0-254, 'sat' : 0-254, 'ct': 154-500
 
         transitiontime : in **deciseconds**, time for this transition to take place
@@ -645,29 +1227,38 @@ class Bridge(object):
         else:
             if isinstance(light_id, int) or isinstance(light_id, str) or isinstance(light_id, unicode):
                 light_id_array = [light_id]
-        result = []
+        converted_lights = []
         for light in light_id_array:
+            if PY3K:
+                if isinstance(light, str):
+                    converted_lights.append(self.get_light_id_by_name(light))
+                else:
+                    converted_lights.append(light)
+            else:
+                if isinstance(light, str) or isinstance(light, unicode):
+                        converted_lights.append(self.get_light_id_by_name(light))
+                else:
+                    converted_lights.append(light)
+
+        def send(target):
+            light, converted_light = target
             logger.debug(str(data))
             if parameter == 'name':
-                result.append(self.request('PUT', '/api/' + self.username + '/lights/' + str(
-                    light_id), json.dumps(data)))
+                response = self.request('PUT', '/api/' + self.username + '/lights/' + str(
+                    light_id), json.dumps(data))
+                self._cache_write('lights', light_id, data, None, response)
+                if 'success' in response[0]:
+                    self._rename(self._light_ids_by_name, light_id, value)
             else:
-                if PY3K:
-                    if isinstance(light, str):
-                        converted_light = self.get_light_id_by_name(light)
-                    else:
-                        converted_light = light
-                else:
-                    if isinstance(light, str) or isinstance(light, unicode):
-                            converted_light = self.get_light_id_by_name(light)
-                    else:
-                        converted_light = light
-                result.append(self.request('PUT', '/api/' + self.username + '/lights/' + str(
-                    converted_light) + '/state', json.dumps(data)))
-            if 'error' in list(result[-1][0].keys()):
+                response = self._put_state('/api/' + self.username + '/lights/' + str(
+                    converted_light) + '/state', data)
+                self._cache_write('lights', converted_light, data, 'state', response)
+            if 'error' in list(response[0].keys()):
                 logger.warn("ERROR: {0} for light {1}".format(
-                    result[-1][0]['error']['description'], light))
+                    response[0]['error']['description'], light))
+            return response
 
+        result = self._fan_out(send, list(zip(light_id_array, converted_lights)))
         logger.debug(result)
         return result
 
@@ -678,16 +1269,16 @@ class Bridge(object):
         return [Group(self, int(groupid)) for groupid in self.get_group().keys()]
 
     def get_group_id_by_name(self, name):
-        """ Lookup a group id based on string name. Case-sensitive. """
-        groups = self.get_group()
-        for group_id in groups:
-            if PY3K:
-                if name == groups[group_id]['name']:
-                    return group_id
-            else:
-                if unicode(name, encoding='utf-8') == groups[group_id]['name']:
-                    return group_id
-        return False
+        """ Lookup a group id based on string name. Case-sensitive.
+
+        Served from a name index kept current by renames, create_group and
+        delete_group; an unknown name reloads the index from the bridge once. """
+        if not PY3K and not isinstance(name, unicode):
+            name = unicode(name, encoding='utf-8')
+        if self._group_ids_by_name is not None and name in self._group_ids_by_name:
+            return self._group_ids_by_name[name]
+        self.get_group()
+        return self._group_ids_by_name.get(name, False)
 
     def get_group(self, group_id=None, parameter=None):
         if PY3K:
@@ -700,18 +1291,28 @@ class Bridge(object):
             logger.error('Group name does not exit')
             return
         if group_id is None:
-            return self.request('GET', '/api/' + self.username + '/groups/')
+            groups = self.request('GET', '/api/' + self.username + '/groups/')
+            if isinstance(groups, dict):
+                self._index_groups(groups)
+                if self.state_cache is not None:
+                    self.state_cache.fill('groups', groups)
+            return groups
         if parameter is None:
             return self.request('GET', '/api/' + self.username + '/groups/' + str(group_id))
-        elif parameter == 'name' or parameter == 'lights':
-            return self.request('GET', '/api/' + self.username + '/groups/' + str(group_id))[parameter]
+        group = self._cached('groups', group_id)
+        if group is None:
+            group = self.request('GET', '/api/' + self.username + '/groups/' + str(group_id))
+        if parameter == 'name' or parameter == 'lights':
+            return group[parameter]
         else:
-            return self.request('GET', '/api/' + self.username + '/groups/' + str(group_id))['action'][parameter]
+            return group['action'][parameter]
 
     def set_group(self, group_id, parameter, value=None, transitiontime=None):
         """ Change light settings for a group
 
-        group_id : int, id number for group
+        group_id : int, id number for group, or a list of them. A list is
+                   written to max_parallel groups at a time; results are
+                   returned in the order of the list.
         parameter : 'name' or 'lights'
         value: string, or list of light IDs if you're setting the lights
 
@@ -737,9 +1338,8 @@ class Bridge(object):
         else:
             if isinstance(group_id, int) or isinstance(group_id, str) or isinstance(group_id, unicode):
                 group_id_array = [group_id]
-        result = []
+        converted_groups = []
         for group in group_id_array:
-            logger.debug(str(data))
             if PY3K:
                 if isinstance(group, str):
                     converted_group = self.get_group_id_by_name(group)
@@ -753,18 +1353,47 @@ class Bridge(object):
             if converted_group is False:
                 logger.error('Group name does not exit')
                 return
+            converted_groups.append(converted_group)
+
+        def send(target):
+            group, converted_group = target
+            logger.debug(str(data))
             if parameter == 'name' or parameter == 'lights':
-                result.append(self.request('PUT', '/api/' + self.username + '/groups/' + str(converted_group), json.dumps(data))) 
+                response = self.request('PUT', '/api/' + self.username + '/groups/' + str(converted_group), json.dumps(data))
+                self._cache_write('groups', converted_group, data, None, response)
+                if parameter == 'name' and 'success' in response[0]:
+                    self._rename(self._group_ids_by_name, converted_group, value)
             else:
-                result.append(self.request('PUT', '/api/' + self.username + '/groups/' + str(converted_group) + '/action', json.dumps(data)))
-        
-        if 'error' in list(result[-1][0].keys()):
-            logger.warn("ERROR: {0} for group {1}".format(
-                result[-1][0]['error']['description'], group))
-
+                response = self._put_state('/api/' + self.username + '/groups/' + str(converted_group) + '/action', data)
+                self._cache_write('groups', converted_group, data, 'action', response)
+                # the lights in the group changed too
+                self.invalidate_cache('lights')
+            if 'error' in list(response[0].keys()):
+                logger.warn("ERROR: {0} for group {1}".format(
+                    response[0]['error']['description'], group))
+            return response
+
+        result = self._fan_out(send, list(zip(group_id_array, converted_groups)))
         logger.debug(result)
         return result
 
+    def set_group_action(self, group_id, data, body=None):
+        """ Set the state of all lights in one group, given by id, from a
+        dict of attributes. Skips the argument handling of set_group, for
+        callers sending the same states over and over.
+
+        body : bytes or string, optional
+            data already encoded as JSON, sent as is
+
+        Returns the bridge's response (not a list of them, as set_group
+        does) """
+        response = self._put_state(
+            '/api/' + self.username + '/groups/' + str(group_id) + '/action', data, body)
+        self._cache_write('groups', group_id, data, 'action', response)
+        # the lights in the group changed too
+        self.invalidate_cache('lights')
+        return response
+
     def create_group(self, name, lights=None):
         """ Create a group of lights
 
@@ -777,17 +1406,78 @@ class Bridge(object):
 
         """
         data = {'lights': [str(x) for x in lights], 'name': name}
-        return self.request('POST', '/api/' + self.username + '/groups/', json.dumps(data))
+        self.invalidate_cache('groups')
+        result = self.request('POST', '/api/' + self.username + '/groups/', json.dumps(data))
+        if isinstance(result, list) and result and 'success' in result[0]:
+            self._rename(self._group_ids_by_name, result[0]['success']['id'], name)
+        return result
 
     def delete_group(self, group_id):
+        self.invalidate_cache('groups', group_id)
+        self._rename(self._group_ids_by_name, group_id, None)
         return self.request('DELETE', '/api/' + self.username + '/groups/' + str(group_id))
 
+    # Scenes #####
+    def get_scene(self, scene_id=None, parameter=None):
+        if scene_id is None:
+            return self.request('GET', '/api/' + self.username + '/scenes')
+        scene = self.request('GET', '/api/' + self.username + '/scenes/' + str(scene_id))
+        if parameter is None:
+            return scene
+        return scene[parameter]
+
+    def create_scene(self, name, lights, lightstates=None, appdata=None, recycle=False):
+        """ Create a scene stored on the bridge
+
+        Parameters
+        ------------
+        name : string
+            Name for this scene, at most 32 characters
+        lights : list
+            List of light ids in the scene
+        lightstates : dict, optional
+            State of each light id, e.g. {'1': {'on': True, 'bri': 200}}.
+            Without it the bridge stores the lights' current states.
+        appdata : dict, optional
+            {'version': int, 'data': string of at most 16 characters},
+            kept for the application that created the scene
+        recycle : bool, optional
+            Whether the bridge may delete the scene when it runs out of room
+
+        """
+        data = {'name': name, 'lights': [str(x) for x in lights], 'recycle': recycle}
+        if lightstates is not None:
+            data['lightstates'] = dict((str(x), state) for x, state in lightstates.items())
+        if appdata is not None:
+            data['appdata'] = appdata
+        return self.request('POST', '/api/' + self.username + '/scenes', json.dumps(data))
+
+    def set_scene_lightstate(self, scene_id, light_id, data):
+        """ Change the state stored for one light of a scene """
+        return self.request(
+            'PUT', '/api/' + self.username + '/scenes/' + str(scene_id) +
+            '/lightstates/' + str(light_id), json.dumps(data))
+
+    def delete_scene(self, scene_id):
+        return self.request('DELETE', '/api/' + self.username + '/scenes/' + str(scene_id))
+
+    def activate_scene(self, group_id, scene_id, transitiontime=None):
+        """ Recall a scene for the lights of a group. The bridge applies
+        the stored state of each light, so one small request sets lights
+        to different colours. """
+        data = {'scene': scene_id}
+        if transitiontime is not None:
+            data['transitiontime'] = transitiontime
+        return self.set_group_action(group_id, data)
+
     # Schedules #####
     def get_schedule(self, schedule_id=None, parameter=None):
         if schedule_id is None:
             return self.request('GET', '/api/' + self.username + '/schedules')
+        schedule = self.request('GET', '/api/' + self.username + '/schedules/' + str(schedule_id))
         if parameter is None:
-            return self.request('GET', '/api/' + self.username + '/schedules/' + str(schedule_id))
+            return schedule
+        return schedule[parameter]
 
     def create_schedule(self, name, time, light_id, data, description=' '):
         schedule = {
@@ -804,10 +1494,27 @@ class Bridge(object):
         }
         return self.request('POST', '/api/' + self.username + '/schedules', json.dumps(schedule))
 
-    def create_group_schedule(self, name, time, group_id, data, description=' '):
+    def create_group_schedule(self, name, time, group_id, data, description=' ', localtime=False):
+        """ Create a schedule setting the lights of a group
+
+        Parameters
+        ------------
+        name : string
+        time : string
+            When to run, e.g. '2017-12-25T07:00:00' once, or
+            'W124/T07:00:00' on weekdays (bitmask of days, Monday = 64
+            down to Sunday = 1)
+        group_id : int
+        data : dict
+            Group action, e.g. {'on': False} or {'scene': scene_id}
+        localtime : bool, optional
+            time is local time rather than UTC. Bridges since API 1.2.1
+            only accept recurring times as local time.
+
+        """
         schedule = {
             'name': name,
-            'time': time,
+            'localtime' if localtime else 'time': time,
             'description': description,
             'command':
             {
@@ -0,0 +1,750 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+phue_async - asyncio backend for phue
+
+AsyncBridge offers the same methods as phue.Bridge, but every call is
+scheduled on the event loop and returns an awaitable instead of blocking.
+Requests share a pool of keep-alive connections, so many commands can be
+in flight at once from a single thread:
+
+    >>> b = AsyncBridge('192.168.1.100', 'username')
+    >>> await asyncio.gather(b.set_light(1, 'on', True), b.set_group(2, 'bri', 100))
+
+AsyncLight, AsyncGroup and AsyncAllLights are the phue.Light, Group and
+AllLights classes for an AsyncBridge. Reading a property returns an
+awaitable of its value, assigning one schedules the command:
+
+    >>> for light in await b.get_light_objects():
+    ...     if await light.on:
+    ...         light.brightness = 100
+
+Requires Python 3.5+.
+'''
+
+import asyncio
+import functools
+import json
+import logging
+
+import phue
+from phue import Group, Light
+
+logger = logging.getLogger('phue')
+
+
+def _scheduled(coroutine_function):
+    """ Run the wrapped coroutine as a task on the bridge's loop, so that the
+    command is sent even if the caller never awaits the result """
+    @functools.wraps(coroutine_function)
+    def wrapper(self, *args, **kwargs):
+        loop = self.loop or asyncio.get_event_loop()
+        return asyncio.ensure_future(
+            coroutine_function(self, *args, **kwargs), loop=loop)
+    return wrapper
+
+
+class _Connection(object):
+
+    """ A single keep-alive HTTP/1.1 connection to the bridge """
+
+    def __init__(self, host, reader, writer):
+        self.host = host
+        self.reader = reader
+        self.writer = writer
+        self.last_used = phue._clock()
+
+    async def request(self, mode, address, data=None):
+        """ Send a request and return (status, body, will_close) """
+        if data is None:
+            body = b''
+        elif isinstance(data, bytes):
+            body = data
+        else:
+            body = data.encode('utf-8')
+        head = '{0} {1} HTTP/1.1\r\nHost: {2}\r\nContent-Length: {3}\r\n'.format(
+            mode, address, self.host, len(body))
+        if body:
+            head += 'Content-Type: application/json\r\n'
+        self.writer.write(head.encode('latin-1') + b'\r\n' + body)
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError('Bridge closed the connection')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            content = b''.join(chunks)
+            will_close = headers.get('connection', '').lower() == 'close'
+        elif 'content-length' in headers:
+            content = await self.reader.readexactly(int(headers['content-length']))
+            will_close = headers.get('connection', '').lower() == 'close'
+        else:
+            content = await self.reader.read()
+            will_close = True
+        self.last_used = phue._clock()
+        return status, content, will_close
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncConnectionPool(object):
+
+    """ Pool of keep-alive asyncio connections to a single bridge
+
+    Mirrors phue.ConnectionPool: idle connections are reused, evicted after
+    idle_timeout seconds, and at most maxsize of them are kept open.
+
+    """
+    def __init__(self, host, maxsize=4, idle_timeout=30, connect_timeout=None):
+        self.host = host
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.stats = {'created': 0, 'reused': 0, 'reconnects': 0,
+                      'evicted': 0, 'discarded': 0}
+        self._idle = []
+
+    async def new_connection(self):
+        host, _, port = self.host.partition(':')
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, int(port or 80)), self.connect_timeout)
+        self.stats['created'] += 1
+        return _Connection(self.host, reader, writer)
+
+    async def acquire(self, reuse=True):
+        """ Returns a (connection, reused) tuple. reuse=False always opens a
+        new connection """
+        now = phue._clock()
+        while self._idle and now - self._idle[0].last_used >= self.idle_timeout:
+            self._idle.pop(0).close()
+            self.stats['evicted'] += 1
+        if self._idle and reuse:
+            self.stats['reused'] += 1
+            return self._idle.pop(), True
+        return (await self.new_connection()), False
+
+    def release(self, connection):
+        if len(self._idle) < self.maxsize:
+            self._idle.append(connection)
+        else:
+            self.stats['discarded'] += 1
+            connection.close()
+
+    def clear(self):
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class AsyncLight(Light):
+
+    """ Hue Light object for an AsyncBridge
+
+    Reading a property returns an awaitable of its value. Assigning one
+    schedules the command on the bridge's loop; use set to await the
+    bridge's response:
+
+        >>> light = AsyncLight(b, 1)
+        >>> if await light.on:
+        ...     light.brightness = 100
+        >>> await light.set('hue', 50000)
+
+    """
+    def __repr__(self):
+        # only the last name read, the name is not requested here
+        return '<{0}.{1} object "{2}" at {3}>'.format(
+            self.__class__.__module__,
+            self.__class__.__name__,
+            self._name,
+            hex(id(self)))
+
+    async def _read(self, parameter, attribute):
+        value = await self._get(parameter)
+        setattr(self, attribute, value)
+        return value
+
+    def set(self, parameter, value=None):
+        """ Schedule a command and return the awaitable response """
+        return self._set(parameter, value)
+
+    @Light.name.getter
+    def name(self):
+        '''Get (awaitable) or set the name of the light [string]'''
+        return self._read('name', '_name')
+
+    @name.setter
+    def name(self, value):
+        old_name = self._name
+        self._name = value
+        self._set('name', value)
+
+        logger.debug("Renaming light from '{0}' to '{1}'".format(
+            old_name, value))
+
+        if old_name in self.bridge.lights_by_name:
+            self.bridge.lights_by_name[value] = self.bridge.lights_by_name.pop(old_name)
+
+    @Light.on.getter
+    def on(self):
+        '''Get (awaitable) or set the state of the light [True|False]'''
+        return self._read('on', '_on')
+
+    @on.setter
+    def on(self, value):
+        # see Light.on, the brightness is sent with the power on so that the
+        # two commands cannot arrive in the wrong order
+        if self._on and value is False:
+            self._reset_bri_after_on = self.transitiontime is not None
+            if self._reset_bri_after_on:
+                logger.warning(
+                    'Turned off light with transitiontime specified, brightness will be reset on power on')
+
+        if self._on is False and value is True and self._reset_bri_after_on:
+            logger.warning(
+                'Light was turned off with transitiontime specified, brightness needs to be reset now.')
+            self._set({'on': True, 'bri': self._brightness})
+            self._reset_bri_after_on = False
+        else:
+            self._set('on', value)
+
+        self._on = value
+
+    @Light.colormode.getter
+    def colormode(self):
+        '''Get the color mode of the light [hs|xy|ct], awaitable'''
+        return self._read('colormode', '_colormode')
+
+    @Light.brightness.getter
+    def brightness(self):
+        '''Get (awaitable) or set the brightness of the light [0-254].
+
+        0 is not off'''
+        return self._read('bri', '_brightness')
+
+    @Light.hue.getter
+    def hue(self):
+        '''Get (awaitable) or set the hue of the light [0-65535]'''
+        return self._read('hue', '_hue')
+
+    @Light.saturation.getter
+    def saturation(self):
+        '''Get (awaitable) or set the saturation of the light [0-254]'''
+        return self._read('sat', '_saturation')
+
+    @Light.xy.getter
+    def xy(self):
+        '''Get (awaitable) or set the color coordinates of the light [ [0.0-1.0, 0.0-1.0] ]'''
+        return self._read('xy', '_xy')
+
+    @Light.colortemp.getter
+    def colortemp(self):
+        '''Get (awaitable) or set the color temperature of the light, in units of mireds [154-500]'''
+        return self._read('ct', '_colortemp')
+
+    @Light.colortemp_k.getter
+    def colortemp_k(self):
+        '''Get (awaitable) or set the color temperature of the light, in units of Kelvin [2000-6500]'''
+        return self._colortemp_k()
+
+    async def _colortemp_k(self):
+        return int(round(1e6 / await self._read('ct', '_colortemp')))
+
+    @Light.effect.getter
+    def effect(self):
+        '''Get (awaitable) or set the effect setting of the light [none|colorloop]'''
+        return self._read('effect', '_effect')
+
+    @Light.alert.getter
+    def alert(self):
+        '''Get (awaitable) or set the alert state of the light [select|lselect|none]'''
+        return self._read('alert', '_alert')
+
+
+class AsyncGroup(AsyncLight, Group):
+
+    """ A group of Hue lights on an AsyncBridge, see AsyncLight
+
+    A group given by name is looked up when first used, an unknown name
+    is logged by AsyncBridge.get_group/set_group rather than raising a
+    LookupError here.
+
+    """
+    def __init__(self, bridge, group_id):
+        Light.__init__(self, bridge, None)
+        del self.light_id  # not relevant for a group
+
+        try:
+            self.group_id = int(group_id)
+        except (TypeError, ValueError):
+            self.group_id = group_id
+
+    @Group.name.getter
+    def name(self):
+        '''Get (awaitable) or set the name of the light group [string]'''
+        return self._read('name', '_name')
+
+    @name.setter
+    def name(self, value):
+        logger.debug("Renaming light group from '{0}' to '{1}'".format(
+            self._name, value))
+        self._name = value
+        self._set('name', value)
+
+    @Group.lights.getter
+    def lights(self):
+        """ Return (awaitable) a list of all lights in this group"""
+        return self._lights()
+
+    async def _lights(self):
+        return [AsyncLight(self.bridge, int(l)) for l in await self._get('lights')]
+
+
+class AsyncAllLights(AsyncGroup):
+
+    """ All the Hue lights connected to an AsyncBridge, see phue.AllLights """
+
+    def __init__(self, bridge):
+        AsyncGroup.__init__(self, bridge, 0)
+
+
+class AsyncBridge(object):
+
+    """ asyncio interface to the Hue ZigBee bridge
+
+    Unlike phue.Bridge, ip and username must both be given; registration and
+    the .python_hue config file are left to the blocking Bridge.
+
+    """
+    def __init__(self, ip, username, loop=None, pool_size=4,
+                 pool_idle_timeout=30, max_in_flight=10,
+                 connect_timeout=5, read_timeout=10):
+        """ Initialization function.
+
+        Parameters:
+        ------------
+        ip : string
+            IP address as dotted quad
+        username : string
+        loop : asyncio event loop, optional
+            Defaults to the loop running when a method is called
+        pool_size : int, optional
+            Number of idle keep-alive connections kept open to the bridge
+        pool_idle_timeout : float, optional
+            Seconds after which an idle connection is closed instead of reused
+        max_in_flight : int, optional
+            Maximum number of requests sent to the bridge at the same time
+        connect_timeout : float, optional
+            Seconds to wait for a TCP connection to the bridge
+        read_timeout : float, optional
+            Seconds to wait for the whole response to a request; None waits
+            forever
+
+        """
+        self.ip = ip
+        self.username = username
+        self.loop = loop
+        self.connection_pool = AsyncConnectionPool(
+            ip, pool_size, pool_idle_timeout, connect_timeout)
+        self.read_timeout = read_timeout
+        self.max_in_flight = max_in_flight
+        self._in_flight = None
+        self.lights_by_id = {}
+        self.lights_by_name = {}
+        # name -> id indexes as in phue.Bridge, None until first loaded;
+        # concurrent lookups of unknown names share one reload per kind
+        self._light_ids_by_name = None
+        self._group_ids_by_name = None
+        self._index_loads = {}
+
+    @property
+    def connection_stats(self):
+        '''Counters for connections created, reused, reconnected and evicted'''
+        return dict(self.connection_pool.stats)
+
+    def close(self):
+        """ Close all idle connections to the bridge """
+        self.connection_pool.clear()
+
+    async def _request(self, mode, address, data):
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        pool = self.connection_pool
+        async with self._in_flight:
+            # see phue.IDEMPOTENT_METHODS
+            connection, reused = await pool.acquire(mode in phue.IDEMPOTENT_METHODS)
+            logger.debug("{0} {1} {2}".format(mode, address, str(data)))
+            try:
+                status, content, will_close = await asyncio.wait_for(
+                    connection.request(mode, address, data), self.read_timeout)
+            except asyncio.TimeoutError:
+                # a slow bridge is not a dropped socket, don't retry
+                connection.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, ValueError, IndexError):
+                connection.close()
+                if not reused:
+                    raise
+                logger.debug('Keep-alive connection dropped, reconnecting')
+                pool.stats['reconnects'] += 1
+                connection = await pool.new_connection()
+                try:
+                    status, content, will_close = await asyncio.wait_for(
+                        connection.request(mode, address, data), self.read_timeout)
+                except:
+                    connection.close()
+                    raise
+        if will_close:
+            connection.close()
+        else:
+            pool.release(connection)
+        return json.loads(content.decode('utf-8'))
+
+    @_scheduled
+    async def request(self, mode='GET', address=None, data=None):
+        """ Utility function for HTTP GET/PUT requests for the API"""
+        return await self._request(mode, address, data)
+
+    @_scheduled
+    async def get_api(self):
+        """ Returns the full api dictionary """
+        return await self._request('GET', '/api/' + self.username, None)
+
+    def _index(self, kind, items):
+        index = dict((info['name'], item_id) for item_id, info in items.items())
+        if kind == 'lights':
+            self._light_ids_by_name = index
+        else:
+            self._group_ids_by_name = index
+
+    def _rename(self, index, item_id, name):
+        """ Point name at item_id in a name index after a rename or create """
+        if index is None:
+            return
+        item_id = str(item_id)
+        for old_name, old_id in list(index.items()):
+            if old_id == item_id:
+                del index[old_name]
+        if name is not None:
+            index[name] = item_id
+
+    async def _id_by_name(self, kind, name):
+        index = self._light_ids_by_name if kind == 'lights' else self._group_ids_by_name
+        if index is not None and name in index:
+            return index[name]
+        load = self._index_loads.get(kind)
+        if load is None:
+            load = asyncio.ensure_future(self._load_index(kind))
+            self._index_loads[kind] = load
+        await load
+        index = self._light_ids_by_name if kind == 'lights' else self._group_ids_by_name
+        if index is None:
+            return False
+        return index.get(name, False)
+
+    async def _load_index(self, kind):
+        try:
+            items = await self._request('GET', '/api/' + self.username + '/' + kind + '/', None)
+            if isinstance(items, dict):
+                self._index(kind, items)
+        finally:
+            self._index_loads.pop(kind, None)
+
+    # Lights #####
+    @_scheduled
+    async def get_light_id_by_name(self, name):
+        """ Lookup a light id based on string name. Case-sensitive.
+
+        Served from a name index as in Bridge.get_light_id_by_name """
+        return await self._id_by_name('lights', name)
+
+    @_scheduled
+    async def get_light_objects(self, mode='list'):
+        """ Same as Bridge.get_light_objects, returning AsyncLight objects """
+        if self.lights_by_id == {}:
+            lights = await self._request('GET', '/api/' + self.username + '/lights/', None)
+            self._index('lights', lights)
+            for light in lights:
+                self.lights_by_id[int(light)] = AsyncLight(self, int(light))
+                self.lights_by_id[int(light)]._name = lights[light]['name']
+                self.lights_by_name[lights[light][
+                    'name']] = self.lights_by_id[int(light)]
+        if mode == 'id':
+            return self.lights_by_id
+        if mode == 'name':
+            return self.lights_by_name
+        if mode == 'list':
+            return [self.lights_by_id[x] for x in sorted(self.lights_by_id)]
+
+    @_scheduled
+    async def get_light(self, light_id=None, parameter=None):
+        """ Gets state by light_id and parameter"""
+        if isinstance(light_id, str):
+            light_id = await self._id_by_name('lights', light_id)
+        if light_id is None:
+            lights = await self._request('GET', '/api/' + self.username + '/lights/', None)
+            if isinstance(lights, dict):
+                self._index('lights', lights)
+            return lights
+        state = await self._request(
+            'GET', '/api/' + self.username + '/lights/' + str(light_id), None)
+        if parameter is None:
+            return state
+        if parameter == 'name':
+            return state[parameter]
+        else:
+            return state['state'][parameter]
+
+    @_scheduled
+    async def set_light(self, light_id, parameter, value=None, transitiontime=None):
+        """ Adjust properties of one or more lights, see Bridge.set_light.
+
+        When light_id is a list, the commands for all lights are sent
+        concurrently and the results are returned in input order.
+
+        """
+        if isinstance(parameter, dict):
+            data = parameter
+        else:
+            data = {parameter: value}
+
+        if transitiontime is not None:
+            data['transitiontime'] = int(round(
+                transitiontime))  # must be int for request format
+
+        light_id_array = light_id
+        if isinstance(light_id, int) or isinstance(light_id, str):
+            light_id_array = [light_id]
+        body = json.dumps(data)
+        logger.debug(body)
+
+        async def send(light):
+            if isinstance(light, str):
+                converted_light = await self._id_by_name('lights', light)
+            else:
+                converted_light = light
+            if parameter == 'name':
+                address = '/api/' + self.username + '/lights/' + str(converted_light)
+            else:
+                address = '/api/' + self.username + '/lights/' + str(converted_light) + '/state'
+            response = await self._request('PUT', address, body)
+            if parameter == 'name' and 'success' in response[0]:
+                self._rename(self._light_ids_by_name, converted_light, value)
+            if 'error' in list(response[0].keys()):
+                logger.warn("ERROR: {0} for light {1}".format(
+                    response[0]['error']['description'], light))
+            return response
+
+        result = await asyncio.gather(*[send(light) for light in light_id_array])
+        result = list(result)
+        logger.debug(result)
+        return result
+
+    # Groups of lights #####
+    @_scheduled
+    async def get_group_id_by_name(self, name):
+        """ Lookup a group id based on string name. Case-sensitive.
+
+        Served from a name index as in Bridge.get_group_id_by_name """
+        return await self._id_by_name('groups', name)
+
+    @_scheduled
+    async def get_group(self, group_id=None, parameter=None):
+        if isinstance(group_id, str):
+            group_id = await self._id_by_name('groups', group_id)
+        if group_id is False:
+            logger.error('Group name does not exit')
+            return
+        if group_id is None:
+            groups = await self._request('GET', '/api/' + self.username + '/groups/', None)
+            if isinstance(groups, dict):
+                self._index('groups', groups)
+            return groups
+        group = await self._request(
+            'GET', '/api/' + self.username + '/groups/' + str(group_id), None)
+        if parameter is None:
+            return group
+        elif parameter == 'name' or parameter == 'lights':
+            return group[parameter]
+        else:
+            return group['action'][parameter]
+
+    @_scheduled
+    async def set_group(self, group_id, parameter, value=None, transitiontime=None):
+        """ Change light settings for a group, see Bridge.set_group """
+        if isinstance(parameter, dict):
+            data = parameter
+        elif parameter == 'lights' and (isinstance(value, list) or isinstance(value, int)):
+            if isinstance(value, int):
+                value = [value]
+            data = {parameter: [str(x) for x in value]}
+        else:
+            data = {parameter: value}
+
+        if transitiontime is not None:
+            data['transitiontime'] = int(round(
+                transitiontime))  # must be int for request format
+
+        group_id_array = group_id
+        if isinstance(group_id, int) or isinstance(group_id, str):
+            group_id_array = [group_id]
+        converted = []
+        for group in group_id_array:
+            if isinstance(group, str):
+                converted_group = await self._id_by_name('groups', group)
+            else:
+                converted_group = group
+            if converted_group is False:
+                logger.error('Group name does not exit')
+                return
+            converted.append(converted_group)
+        body = json.dumps(data)
+        logger.debug(body)
+
+        async def send(group, converted_group):
+            if parameter == 'name' or parameter == 'lights':
+                address = '/api/' + self.username + '/groups/' + str(converted_group)
+            else:
+                address = '/api/' + self.username + '/groups/' + str(converted_group) + '/action'
+            response = await self._request('PUT', address, body)
+            if parameter == 'name' and 'success' in response[0]:
+                self._rename(self._group_ids_by_name, converted_group, value)
+            if 'error' in list(response[0].keys()):
+                logger.warn("ERROR: {0} for group {1}".format(
+                    response[0]['error']['description'], group))
+            return response
+
+        result = await asyncio.gather(
+            *[send(group, c) for group, c in zip(group_id_array, converted)])
+        result = list(result)
+        logger.debug(result)
+        return result
+
+    @_scheduled
+    async def set_group_action(self, group_id, data, body=None):
+        """ Set the state of all lights in one group, see
+        Bridge.set_group_action """
+        if body is None:
+            body = json.dumps(data)
+        return await self._request(
+            'PUT', '/api/' + self.username + '/groups/' + str(group_id) + '/action', body)
+
+    @_scheduled
+    async def create_group(self, name, lights=None):
+        """ Create a group of lights, see Bridge.create_group """
+        data = {'lights': [str(x) for x in lights], 'name': name}
+        result = await self._request('POST', '/api/' + self.username + '/groups/', json.dumps(data))
+        if isinstance(result, list) and result and 'success' in result[0]:
+            self._rename(self._group_ids_by_name, result[0]['success']['id'], name)
+        return result
+
+    @_scheduled
+    async def delete_group(self, group_id):
+        self._rename(self._group_ids_by_name, group_id, None)
+        return await self._request('DELETE', '/api/' + self.username + '/groups/' + str(group_id), None)
+
+    # Scenes #####
+    @_scheduled
+    async def get_scene(self, scene_id=None, parameter=None):
+        if scene_id is None:
+            return await self._request('GET', '/api/' + self.username + '/scenes', None)
+        scene = await self._request(
+            'GET', '/api/' + self.username + '/scenes/' + str(scene_id), None)
+        if parameter is None:
+            return scene
+        return scene[parameter]
+
+    @_scheduled
+    async def create_scene(self, name, lights, lightstates=None, appdata=None, recycle=False):
+        """ Create a scene stored on the bridge, see Bridge.create_scene """
+        data = {'name': name, 'lights': [str(x) for x in lights], 'recycle': recycle}
+        if lightstates is not None:
+            data['lightstates'] = dict((str(x), state) for x, state in lightstates.items())
+        if appdata is not None:
+            data['appdata'] = appdata
+        return await self._request('POST', '/api/' + self.username + '/scenes', json.dumps(data))
+
+    @_scheduled
+    async def set_scene_lightstate(self, scene_id, light_id, data):
+        return await self._request(
+            'PUT', '/api/' + self.username + '/scenes/' + str(scene_id) +
+            '/lightstates/' + str(light_id), json.dumps(data))
+
+    @_scheduled
+    async def delete_scene(self, scene_id):
+        return await self._request('DELETE', '/api/' + self.username + '/scenes/' + str(scene_id), None)
+
+    @_scheduled
+    async def activate_scene(self, group_id, scene_id, transitiontime=None):
+        """ Recall a scene for the lights of a group, see
+        Bridge.activate_scene """
+        data = {'scene': scene_id}
+        if transitiontime is not None:
+            data['transitiontime'] = transitiontime
+        return await self.set_group_action(group_id, data)
+
+    # Schedules #####
+    @_scheduled
+    async def get_schedule(self, schedule_id=None, parameter=None):
+        if schedule_id is None:
+            return await self._request('GET', '/api/' + self.username + '/schedules', None)
+        schedule = await self._request(
+            'GET', '/api/' + self.username + '/schedules/' + str(schedule_id), None)
+        if parameter is None:
+            return schedule
+        return schedule[parameter]
+
+    @_scheduled
+    async def create_schedule(self, name, time, light_id, data, description=' '):
+        schedule = {
+            'name': name,
+            'time': time,
+            'description': description,
+            'command':
+            {
+            'method': 'PUT',
+            'address': '/api/' + self.username +
+                '/lights/' + str(light_id) + '/state',
+            'body': data
+            }
+        }
+        return await self._request('POST', '/api/' + self.username + '/schedules', json.dumps(schedule))
+
+    @_scheduled
+    async def create_group_schedule(self, name, time, group_id, data, description=' ', localtime=False):
+        """ Create a schedule setting the lights of a group, see
+        Bridge.create_group_schedule """
+        schedule = {
+            'name': name,
+            'localtime' if localtime else 'time': time,
+            'description': description,
+            'command':
+            {
+            'method': 'PUT',
+            'address': '/api/' + self.username +
+                '/groups/' + str(group_id) + '/action',
+            'body': data
+            }
+        }
+        return await self._request('POST', '/api/' + self.username + '/schedules', json.dumps(schedule))
+
+    @_scheduled
+    async def delete_schedule(self, schedule_id):
+        return await self._request('DELETE', '/api/' + self.username + '/schedules/' + str(schedule_id), None)
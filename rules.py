@@ -0,0 +1,180 @@
+"""
+rules
+
+Declarative rules turning the phone queue numbers into a light state,
+from the 'rules' entry of the config:
+
+	{
+		"scoring": {"calls": 1, "waitMinutes": 1, "ready": 0},
+		"bands": [
+			{"min": 0, "state": "green", "readyState": "blue"},
+			{"above": 0, "state": "greenYellow"},
+			{"min": 4, "state": "yellow"},
+			{"min": 7, "state": "orange"},
+			{"min": 9, "state": "red"}
+		],
+		"overrides": [
+			{"days": ["saturday", "sunday"], "from": "11:00", "to": "13:00",
+			 "bands": [...], "scoring": {...}}
+		]
+	}
+
+Points are calls * calls weight + whole minutes waited by the longest
+waiting call * waitMinutes weight + agents ready * ready weight. Queues
+are combined before scoring, see 'queueAggregation' (the 'weighted' rule
+applies each queue's 'weight').
+
+Each band starts at "min" (points >= min) or "above" (points > above)
+and runs up to the start of the next band; points below the first band
+use the first band. "readyState", if given, is used instead of "state"
+while agents are ready.
+
+Overrides replace the scoring and/or bands during a window of local
+time on the given days (default every day); a window whose "to" is not
+after its "from" runs past midnight. The first override listed wins
+where windows overlap.
+
+The bands are compiled into a sorted table of breakpoints: "min": x
+becomes the key (x, 0) and "above": x the key (x, 1), so looking up the
+key (points, 0.5) with bisect finds the band for any number of bands.
+"""
+
+import bisect
+import time
+
+from businesshours import DAYS, MINUTES_PER_WEEK, parse_minutes
+
+DEFAULT_SCORING = {'calls': 1, 'waitMinutes': 1, 'ready': 0}
+
+class RuleTable(object):
+
+	"""Scoring weights and bands compiled into a breakpoint table."""
+
+	def __init__(self, scoring, bands, stateNames=None):
+		"""scoring : dict of weights, see DEFAULT_SCORING
+		bands : list of band dicts
+		stateNames : collection, optional
+			Light state names the bands may use; others raise ValueError"""
+		unknown = set(scoring) - set(DEFAULT_SCORING)
+		if unknown:
+			raise ValueError('Unknown scoring terms: {}'.format(', '.join(sorted(unknown))))
+		weights = dict(DEFAULT_SCORING)
+		weights.update(scoring)
+		self.callWeight = weights['calls']
+		self.waitWeight = weights['waitMinutes']
+		self.readyWeight = weights['ready']
+		if not bands:
+			raise ValueError('At least one band is needed')
+		entries = []
+		for band in bands:
+			if 'min' in band:
+				key = (band['min'], 0)
+			elif 'above' in band:
+				key = (band['above'], 1)
+			else:
+				raise ValueError('Band needs "min" or "above": {}'.format(band))
+			if not isinstance(key[0], (int, float)):
+				raise ValueError('Band threshold must be a number: {}'.format(band))
+			state = band['state']
+			readyState = band.get('readyState', state)
+			for name in (state, readyState):
+				if stateNames is not None and name not in stateNames:
+					raise ValueError("Band uses unknown light state '{}'".format(name))
+			entries.append((key, state, readyState))
+		entries.sort(key=lambda entry: entry[0])
+		self.keys = [key for key, state, readyState in entries]
+		if len(set(self.keys)) != len(self.keys):
+			raise ValueError('Two bands start at the same points')
+		self.states = [state for key, state, readyState in entries]
+		self.readyStates = [readyState for key, state, readyState in entries]
+		# "min" breakpoints above the first band, where the lights change
+		# with one more point
+		self.thresholds = tuple(value for value, kind in self.keys[1:] if kind == 0)
+
+	def points(self, calls, waitTime, ready=0):
+		return calls * self.callWeight + (waitTime // 60) * self.waitWeight + ready * self.readyWeight
+
+	def lookup(self, points, ready=0):
+		"""Returns the light state name for points."""
+		i = max(bisect.bisect_right(self.keys, (points, 0.5)) - 1, 0)
+		if ready:
+			return self.readyStates[i]
+		return self.states[i]
+
+	def state_names(self):
+		return set(self.states) | set(self.readyStates)
+
+class RuleEngine(object):
+
+	"""The base rule table and the override tables, selected by the local
+	time. The table in force is looked up once per minute."""
+
+	def __init__(self, scoring, bands, overrides=(), stateNames=None):
+		self.tables = [RuleTable(scoring, bands, stateNames)]
+		# minute of the week -> index into tables, as sorted breakpoints
+		windows = []
+		for override in overrides:
+			self.tables.append(RuleTable(override.get('scoring', scoring), override.get('bands', bands), stateNames))
+			days = override.get('days', DAYS)
+			start, end = parse_minutes(override['from']), parse_minutes(override['to'])
+			if end <= start:
+				end += 1440
+			for day in days:
+				if day not in DAYS:
+					raise ValueError('Unknown day in override: {}'.format(day))
+				offset = DAYS.index(day) * 1440
+				windows.append((offset + start, offset + end, len(self.tables) - 1))
+		# split windows running past the end of the week
+		for first, last, index in list(windows):
+			if last > MINUTES_PER_WEEK:
+				windows.append((0, last - MINUTES_PER_WEEK, index))
+		edges = sorted(set([0] + [edge for first, last, index in windows for edge in (first, min(last, MINUTES_PER_WEEK))]))
+		self.edges = []
+		self.edgeTables = []
+		for edge in edges:
+			if edge >= MINUTES_PER_WEEK:
+				continue
+			# first override listed wins
+			index = min([i for first, last, i in windows if first <= edge < last] or [0],
+				key=lambda i: i if i else len(self.tables))
+			if not self.edgeTables or self.edgeTables[-1] != index:
+				self.edges.append(edge)
+				self.edgeTables.append(index)
+		self.cachedMinute = None
+		self.cachedTable = None
+
+	@classmethod
+	def from_config(cls, rules, stateNames=None):
+		"""Builds the engine from the 'rules' config entry."""
+		return cls(rules.get('scoring', DEFAULT_SCORING), rules['bands'], rules.get('overrides', ()), stateNames)
+
+	def table(self, now=None):
+		"""Returns the RuleTable in force at now (default: the current time)."""
+		if now is None:
+			now = time.time()
+		minute = int(now // 60)
+		if minute != self.cachedMinute:
+			local = time.localtime(now)
+			minuteOfWeek = local.tm_wday * 1440 + local.tm_hour * 60 + local.tm_min
+			index = self.edgeTables[bisect.bisect_right(self.edges, minuteOfWeek) - 1]
+			self.cachedMinute, self.cachedTable = minute, self.tables[index]
+		return self.cachedTable
+
+	def points(self, calls, waitTime, ready=0, now=None):
+		return self.table(now).points(calls, waitTime, ready)
+
+	def state(self, points, ready=0, now=None):
+		"""Returns the name of the light state for points."""
+		return self.table(now).lookup(points, ready)
+
+	def thresholds(self, now=None):
+		"""Returns the points at which the lights change colour, other than
+		leaving the first band."""
+		return self.table(now).thresholds
+
+	def state_names(self):
+		"""Returns the names of all light states the rules can choose."""
+		names = set()
+		for table in self.tables:
+			names |= table.state_names()
+		return names